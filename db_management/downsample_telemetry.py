@@ -0,0 +1,266 @@
+#!/usr/bin/python
+import psycopg2  # pip install psycopg2-binary
+import logging
+import time
+
+from maintenance import vacuum_where_needed, MaintenanceMetrics
+
+# Run as user postgres
+
+"""
+This script thins out telemetry that grows without bound in ts_kv, according to a per-key retention policy:
+    1) Raw values are kept until they are raw_days old
+    2) After that, they are replaced by hourly min/max/avg rollups, kept until they are hourly_days old
+    3) After that, hourly rollups are replaced by daily ones, kept until they are daily_days old
+A period of None means keep forever.
+
+Rollups live in ts_kv_rollup, alongside ts_kv.  As with remove_old_uptime_records.py, work is done one device at a time in small
+batches, each of which rolls up and deletes its rows in a single statement and is committed straight away, so a batch is never
+half done and locks are only held briefly.  Each batch takes the oldest rows that are due, so an interrupted run simply carries on
+where it left off next time.
+
+uptime is left to remove_old_uptime_records.py, which keeps the records marking reboots.
+
+Only our own devices are downsampled.  Devices fed by the importers in management/ (PurpleAir sensors, and the DEQ stations whose
+data calibration.py uses as its reference) are left entirely alone, whatever keys they share with ours, so their data stays raw
+and consistent across keys.
+
+To be run daily via cron
+"""
+
+logging.basicConfig(filename="/var/log/db_maintenance.log", level=logging.DEBUG, format="%(asctime)s %(levelname)s %(message)s", datefmt="%d %b %Y %H:%M:%S")
+
+DAY = 24 * 60 * 60 * 1000
+HOUR = 60 * 60 * 1000
+
+PM_POLICY = {"raw_days": 365, "hourly_days": None, "daily_days": None}
+WEATHER_POLICY = {"raw_days": 365, "hourly_days": None, "daily_days": None}
+DIAGNOSTIC_POLICY = {"raw_days": 14, "hourly_days": 90, "daily_days": 365}
+
+RETENTION_POLICY = {
+    "freeHeap":                 DIAGNOSTIC_POLICY,
+    "wifiDistance":             DIAGNOSTIC_POLICY,
+    "wifiDistanceAccuracy":     DIAGNOSTIC_POLICY,
+    "plantowerSampleCount":     DIAGNOSTIC_POLICY,
+
+    "temperature":              WEATHER_POLICY,
+    "temperature_smoothed":     WEATHER_POLICY,
+    "humidity":                 WEATHER_POLICY,
+    "pressure":                 WEATHER_POLICY,
+
+    "plantowerPM1conc":         PM_POLICY,
+    "plantowerPM25conc":        PM_POLICY,
+    "plantowerPM10conc":        PM_POLICY,
+    "plantowerPM1concRaw":      PM_POLICY,
+    "plantowerPM25concRaw":     PM_POLICY,
+    "plantowerPM10concRaw":     PM_POLICY,
+}
+
+# Importer devices, which we never touch: PurpleAir devices are created by purple.py with this type, and DEQ devices are named
+# after their stations, e.g. "DEQ (SEL)"
+EXCLUDED_DEVICE_TYPES = ("PurpleAir",)
+EXCLUDED_DEVICE_NAMES = "DEQ (%"         # LIKE pattern
+
+BATCH_SIZE = 5000               # Rows per transaction
+PAUSE_BETWEEN_BATCHES = 0.1     # Seconds; give other writers a look-in
+MAX_RUNTIME = 60 * 60           # Seconds; stop here and let tomorrow's run carry on
+LOCK_TIMEOUT = "5s"             # Give up on a batch rather than queue behind a long-running lock
+
+# When one batch merges into a bucket another batch already wrote, combine the two rather than replacing
+MERGE_ROLLUP = """
+    ON CONFLICT (entity_type, entity_id, key, period, ts) DO UPDATE SET
+        min_v = LEAST(ts_kv_rollup.min_v, excluded.min_v),
+        max_v = GREATEST(ts_kv_rollup.max_v, excluded.max_v),
+        avg_v = (ts_kv_rollup.avg_v * ts_kv_rollup.count_v + excluded.avg_v * excluded.count_v) / (ts_kv_rollup.count_v + excluded.count_v),
+        count_v = ts_kv_rollup.count_v + excluded.count_v
+    """
+
+
+def main():
+    logging.info("Starting telemetry downsampling")
+    con = None
+    metrics = MaintenanceMetrics("downsample_telemetry")
+    success = False
+
+    try:
+        con = psycopg2.connect("dbname='thingsboard'")
+        with con.cursor() as cur:
+            cur.execute("SET lock_timeout = %s", (LOCK_TIMEOUT,))
+        con.commit()
+
+        create_rollup_table(con)
+        metrics.record_table_sizes(con, "ts_kv%", "before")
+
+        rows = downsample(con, RETENTION_POLICY, metrics)
+        logging.info("Downsampled " + str(rows) + " telemetry records")
+
+        if rows:
+            with metrics.step("vacuum"):
+                metrics.record_vacuums(vacuum_where_needed(con, "ts_kv%"))
+
+        metrics.record_table_sizes(con, "ts_kv%", "after")
+        success = True
+
+    except psycopg2.DatabaseError as e:
+        logging.error("Error downsampling telemetry: %s" % e)
+
+    finally:
+        if con:
+            con.close()
+        metrics.write(success)
+
+
+def create_rollup_table(con):
+    with con.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ts_kv_rollup (
+                entity_type varchar(255) NOT NULL,
+                entity_id   varchar(31)  NOT NULL,
+                key         varchar(255) NOT NULL,
+                period      varchar(8)   NOT NULL,     -- 'hour' or 'day'
+                ts          bigint       NOT NULL,     -- Start of the period
+                min_v       double precision,
+                max_v       double precision,
+                avg_v       double precision,
+                count_v     bigint       NOT NULL,
+                PRIMARY KEY (entity_type, entity_id, key, period, ts)
+            )
+            """)
+    con.commit()
+
+
+def get_cutoff(con, days):
+    with con.cursor() as cur:
+        cur.execute("SELECT trunc(extract(epoch from now()) * 1000)::bigint - %s", (days * DAY,))
+        return cur.fetchone()[0]
+
+
+def get_entities(con, key):
+    # ts_kv_latest has one row per device and key, so this is far cheaper than scanning ts_kv
+    with con.cursor() as cur:
+        cur.execute("""
+            SELECT DISTINCT L.entity_type, L.entity_id
+            FROM ts_kv_latest L
+            JOIN device D ON D.id = L.entity_id
+            WHERE L.key = %s  AND  L.entity_type = 'DEVICE'
+                AND  D.type NOT IN %s  AND  D.name NOT LIKE %s
+            ORDER BY L.entity_id
+            """, (key, EXCLUDED_DEVICE_TYPES, EXCLUDED_DEVICE_NAMES))
+        return cur.fetchall()
+
+
+def downsample(con, policies, metrics):
+    """
+    Applies each key's policy to every one of our devices that reports it.  Returns the number of rows removed from ts_kv and ts_kv_rollup.
+    """
+    started = time.time()
+    total = 0
+
+    for key, policy in policies.items():
+        steps = [("raw", policy["raw_days"], ROLLUP_RAW), ("hourly", policy["hourly_days"], ROLLUP_HOURLY), ("daily", policy["daily_days"], DELETE_DAILY)]
+
+        for name, days, step in steps:
+            if days is None:    # Keep forever, and so nothing ever reaches the later steps
+                break
+
+            cutoff = get_cutoff(con, days)
+            step_started = time.time()
+            rows = 0
+
+            for entity_type, entity_id in get_entities(con, key):
+                if time.time() - started > MAX_RUNTIME:
+                    logging.info("Out of time; will carry on with the next run")
+                    return total + rows
+
+                rows += run_in_batches(con, step, entity_type, entity_id, key, cutoff)
+
+            elapsed = time.time() - step_started
+            metrics.add_step(key + "_" + name, elapsed)
+            metrics.count("rows_" + name, rows)
+            logging.info("%s %s: %d rows in %.0f seconds (%.0f rows/sec)" % (key, name, rows, elapsed, rows / elapsed if elapsed else 0))
+            total += rows
+
+    return total
+
+
+def run_in_batches(con, step, entity_type, entity_id, key, cutoff):
+    rows = 0
+
+    while True:
+        with con.cursor() as cur:
+            cur.execute(step, {"entity_type": entity_type, "entity_id": entity_id, "key": key, "cutoff": cutoff, "limit": BATCH_SIZE})
+            count = cur.fetchone()[0]
+        con.commit()
+
+        rows += count
+        if count < BATCH_SIZE:
+            return rows
+
+        time.sleep(PAUSE_BETWEEN_BATCHES)
+
+
+# Each step is a single statement handling one batch of one device's rows older than cutoff, and returning the number of rows
+# removed.  Only numeric values are rolled up; string and boolean values are left alone.
+ROLLUP_RAW = """
+    WITH batch AS (
+        DELETE FROM ts_kv K
+        USING ( SELECT entity_type, entity_id, key, ts
+                FROM ts_kv
+                WHERE entity_type = %(entity_type)s  AND  entity_id = %(entity_id)s  AND  key = %(key)s  AND  ts < %(cutoff)s
+                    AND  (dbl_v IS NOT NULL  OR  long_v IS NOT NULL)
+                ORDER BY ts
+                LIMIT %(limit)s
+            ) AS oldest
+        WHERE K.entity_type = oldest.entity_type  AND  K.entity_id = oldest.entity_id  AND  K.key = oldest.key  AND  K.ts = oldest.ts
+        RETURNING K.ts, COALESCE(K.dbl_v, K.long_v::double precision) AS v
+    ),
+    rolled_up AS (
+        INSERT INTO ts_kv_rollup (entity_type, entity_id, key, period, ts, min_v, max_v, avg_v, count_v)
+        SELECT %(entity_type)s, %(entity_id)s, %(key)s, 'hour', ts - ts %% """ + str(HOUR) + """, min(v), max(v), avg(v), count(*)
+        FROM batch
+        GROUP BY 5
+        """ + MERGE_ROLLUP + """
+    )
+    SELECT count(*) FROM batch
+    """
+
+ROLLUP_HOURLY = """
+    WITH batch AS (
+        DELETE FROM ts_kv_rollup R
+        USING ( SELECT ts
+                FROM ts_kv_rollup
+                WHERE entity_type = %(entity_type)s  AND  entity_id = %(entity_id)s  AND  key = %(key)s  AND  period = 'hour'  AND  ts < %(cutoff)s
+                ORDER BY ts
+                LIMIT %(limit)s
+            ) AS oldest
+        WHERE R.entity_type = %(entity_type)s  AND  R.entity_id = %(entity_id)s  AND  R.key = %(key)s  AND  R.period = 'hour'  AND  R.ts = oldest.ts
+        RETURNING R.ts, R.min_v, R.max_v, R.avg_v, R.count_v
+    ),
+    rolled_up AS (
+        INSERT INTO ts_kv_rollup (entity_type, entity_id, key, period, ts, min_v, max_v, avg_v, count_v)
+        SELECT %(entity_type)s, %(entity_id)s, %(key)s, 'day', ts - ts %% """ + str(DAY) + """, min(min_v), max(max_v), sum(avg_v * count_v) / sum(count_v), sum(count_v)
+        FROM batch
+        GROUP BY 5
+        """ + MERGE_ROLLUP + """
+    )
+    SELECT count(*) FROM batch
+    """
+
+DELETE_DAILY = """
+    WITH batch AS (
+        DELETE FROM ts_kv_rollup R
+        USING ( SELECT ts
+                FROM ts_kv_rollup
+                WHERE entity_type = %(entity_type)s  AND  entity_id = %(entity_id)s  AND  key = %(key)s  AND  period = 'day'  AND  ts < %(cutoff)s
+                ORDER BY ts
+                LIMIT %(limit)s
+            ) AS oldest
+        WHERE R.entity_type = %(entity_type)s  AND  R.entity_id = %(entity_id)s  AND  R.key = %(key)s  AND  R.period = 'day'  AND  R.ts = oldest.ts
+        RETURNING R.ts
+    )
+    SELECT count(*) FROM batch
+    """
+
+
+if __name__ == "__main__":
+    main()
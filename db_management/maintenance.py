@@ -0,0 +1,195 @@
+from psycopg2 import sql  # pip install psycopg2-binary
+import contextlib
+import json
+import logging
+import os
+import time
+
+"""
+Helpers shared by the db_management scripts.
+"""
+
+# A table is vacuumed once this many of its rows are dead (and at least DEAD_TUPLE_MIN), and analyzed once this many have changed
+# since it was last analyzed (and at least CHANGED_TUPLE_MIN).  Anything below that is left to autovacuum.
+DEAD_TUPLE_FRACTION = 0.02
+DEAD_TUPLE_MIN = 10000
+CHANGED_TUPLE_FRACTION = 0.05
+CHANGED_TUPLE_MIN = 10000
+
+# Every run appends a line here...
+METRICS_JSON_FILE = "/var/log/db_maintenance_metrics.jsonl"
+# ...and, if node_exporter's textfile collector is set up, replaces its file here
+PROMETHEUS_TEXTFILE_DIR = "/var/lib/node_exporter/textfile_collector"
+
+
+# Adapted from https://nessy.info/?p=886
+def vacuum(con, table, analyze=False, analyze_only=False):
+    """
+    Run vacuum (and/or analyze) on specified table, which may be a name or an sql.Identifier
+    """
+
+    if isinstance(table, str):
+        table = sql.Identifier(table)
+
+    query = sql.SQL("ANALYZE {}" if analyze_only else "VACUUM ANALYZE {}" if analyze else "VACUUM {}").format(table)
+
+    # VACUUM can not run in a transaction block,
+    # which psycopg2 uses by default.
+    # http://bit.ly/1OUbYB3
+    isolation_level = con.isolation_level
+    con.set_isolation_level(0)
+
+    cur = con.cursor()
+    cur.execute(query)
+
+    # Restore isolation_level
+    con.set_isolation_level(isolation_level)
+
+    return con.notices
+
+
+def get_table_stats(con, pattern):
+    """
+    Returns [(schema, table, live rows, dead rows, rows changed since last analyze)] for tables (including partitions) whose names
+    match the LIKE pattern.
+    """
+    with con.cursor() as cur:
+        cur.execute("""
+            SELECT schemaname, relname, n_live_tup, n_dead_tup, n_mod_since_analyze
+            FROM pg_stat_user_tables
+            WHERE relname LIKE %s
+            ORDER BY relname
+            """, (pattern,))
+        rows = cur.fetchall()
+    con.commit()
+
+    return rows
+
+
+def vacuum_where_needed(con, pattern):
+    """
+    Vacuums or analyzes only those tables matching pattern that have enough dead or changed rows to be worth it, rather than
+    vacuuming everything.  Returns [(table, action, seconds)] for the work done.
+    """
+    done = []
+
+    for schema, table, live, dead, changed in get_table_stats(con, pattern):
+        needs_vacuum = dead >= max(DEAD_TUPLE_MIN, live * DEAD_TUPLE_FRACTION)
+        needs_analyze = changed >= max(CHANGED_TUPLE_MIN, live * CHANGED_TUPLE_FRACTION)
+
+        if not needs_vacuum and not needs_analyze:
+            logging.debug("Skipping %s (%d live, %d dead, %d changed)" % (table, live, dead, changed))
+            continue
+
+        action = "vacuum analyze" if needs_vacuum and needs_analyze else "vacuum" if needs_vacuum else "analyze"
+        started = time.time()
+        vacuum(con, sql.Identifier(schema, table), analyze=needs_analyze, analyze_only=not needs_vacuum)
+        elapsed = time.time() - started
+
+        logging.info("%s %s (%d live, %d dead, %d changed) took %.1f seconds" % (action.capitalize(), table, live, dead, changed, elapsed))
+        done.append((table, action, elapsed))
+
+    return done
+
+
+class MaintenanceMetrics:
+    """
+    Collects timings, row counts and table sizes for one run of a maintenance job, so we can see how its cost changes as the fleet
+    grows.  Call write() at the end of the run, whether or not it succeeded.
+    """
+    def __init__(self, job):
+        self.job = job
+        self.started = time.time()
+        self.steps = {}         # step => seconds
+        self.counts = {}        # name => number, e.g. rows_deleted
+        self.tables = {}        # table => {"table_bytes_before": ..., "index_bytes_after": ..., "vacuum_seconds": ...}
+
+    @contextlib.contextmanager
+    def step(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_step(name, time.time() - started)
+
+    def add_step(self, name, seconds):
+        self.steps[name] = self.steps.get(name, 0) + seconds
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def record_table_sizes(self, con, pattern, when):
+        """
+        Records the size of each table (and partition) matching pattern, and of its indexes; when is "before" or "after".
+        """
+        with con.cursor() as cur:
+            cur.execute("""
+                SELECT relname, pg_table_size(oid), pg_indexes_size(oid)
+                FROM pg_class
+                WHERE relname LIKE %s  AND  relkind = 'r'
+                """, (pattern,))
+            rows = cur.fetchall()
+        con.commit()
+
+        for table, table_bytes, index_bytes in rows:
+            sizes = self.tables.setdefault(table, {})
+            sizes["table_bytes_" + when] = table_bytes
+            sizes["index_bytes_" + when] = index_bytes
+
+    def record_vacuums(self, vacuums):
+        """
+        Takes the list returned by vacuum_where_needed()
+        """
+        for table, action, seconds in vacuums:
+            self.tables.setdefault(table, {})["vacuum_seconds"] = seconds
+
+    def write(self, success):
+        finished = time.time()
+        record = {
+            "job": self.job,
+            "started": self.started,
+            "finished": finished,
+            "success": success,
+            "duration_seconds": finished - self.started,
+            "steps": self.steps,
+            "counts": self.counts,
+            "tables": self.tables,
+        }
+
+        try:
+            with open(METRICS_JSON_FILE, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+            if os.path.isdir(PROMETHEUS_TEXTFILE_DIR):
+                self.write_prometheus(record)
+
+        except OSError as e:
+            logging.error("Error writing maintenance metrics: %s" % e)
+
+    def write_prometheus(self, record):
+        job = 'job="%s"' % self.job
+        lines = [
+            "db_maintenance_last_run_timestamp_seconds{%s} %f" % (job, record["finished"]),
+            "db_maintenance_last_run_success{%s} %d" % (job, record["success"]),
+            "db_maintenance_duration_seconds{%s} %f" % (job, record["duration_seconds"]),
+        ]
+
+        lines += ['db_maintenance_step_duration_seconds{%s,step="%s"} %f' % (job, step, seconds) for step, seconds in self.steps.items()]
+        lines += ['db_maintenance_count{%s,name="%s"} %d' % (job, name, value) for name, value in self.counts.items()]
+
+        for table, values in sorted(self.tables.items()):
+            for name, value in sorted(values.items()):
+                if name == "vacuum_seconds":
+                    lines.append('db_maintenance_vacuum_duration_seconds{%s,table="%s"} %f' % (job, table, value))
+                else:
+                    kind, _, when = name.rpartition("_")      # e.g. index_bytes, after
+                    lines.append('db_maintenance_%s{%s,table="%s",when="%s"} %d' % (kind, job, table, when, value))
+
+        # Lines for each metric have to be grouped together
+        lines.sort(key=lambda line: line.split("{")[0])
+
+        # node_exporter may read the file at any moment, so write it elsewhere and move it into place
+        filename = os.path.join(PROMETHEUS_TEXTFILE_DIR, "db_maintenance_%s.prom" % self.job)
+        with open(filename + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(filename + ".tmp", filename)
@@ -0,0 +1,394 @@
+#!/usr/bin/python
+import psycopg2  # pip install psycopg2-binary
+from psycopg2 import sql
+import argparse
+import datetime
+import logging
+import re
+import time
+
+# Run as user postgres
+
+"""
+This script converts ThingsBoard's ts_kv table into one partitioned by month (ts_kv_2019_01, ts_kv_2019_02, ...), without taking
+ThingsBoard offline.  Once done, throwing away a month of old data is a quick DROP rather than a huge DELETE, and queries for a
+time range only touch the months they need.  Requires Postgres 11 or later.
+
+Conversion happens in steps, each of which can be run with --dry-run to see what it would do:
+
+    prepare     Creates ts_kv_partitioned with a partition for every month ts_kv has data for (plus a few ahead, and a default
+                partition to catch anything else), and a trigger on ts_kv that copies every new or changed row across.  With
+                --dry-run, also estimates how big each partition will be, from a sample of ts_kv.
+    copy        Copies existing rows across in small batches, in primary key order, committing after each.  Can be interrupted and
+                rerun; it picks up from the last batch committed.
+    swap        Renames ts_kv to ts_kv_old and ts_kv_partitioned to ts_kv, in one short transaction.  Check ts_kv_old before
+                dropping it.
+
+Other db_management scripts should not be run while the copy is in progress.  Afterwards:
+
+    create-partitions   Creates partitions for the coming months; run this monthly via cron
+    drop-before         Drops partitions for months before the one given, e.g. drop-before 2019-06
+"""
+
+logging.basicConfig(filename="/var/log/db_maintenance.log", level=logging.DEBUG, format="%(asctime)s %(levelname)s %(message)s", datefmt="%d %b %Y %H:%M:%S")
+logging.getLogger().addHandler(logging.StreamHandler())     # Usually run by hand, so report progress on the console too
+
+NEW_TABLE = "ts_kv_partitioned"
+OLD_TABLE = "ts_kv_old"
+DEFAULT_PARTITION = "ts_kv_default"
+PROGRESS_TABLE = "ts_kv_partition_progress"
+PRIMARY_KEY = "entity_type, entity_id, key, ts"
+
+MONTHS_AHEAD = 3                # Partitions to create beyond the current month
+BATCH_SIZE = 20000              # Rows copied per transaction
+PAUSE_BETWEEN_BATCHES = 0.1     # Seconds; give ThingsBoard a look-in
+LOCK_TIMEOUT = "5s"             # Give up rather than queue ThingsBoard's writes behind us for long
+SAMPLE_PERCENT = 1              # Share of ts_kv to read when estimating partition sizes
+
+# Keeps ts_kv_partitioned up to date with everything ThingsBoard writes while we copy
+MIRROR_TRIGGER = """
+    CREATE OR REPLACE FUNCTION ts_kv_mirror() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            DELETE FROM ts_kv_partitioned
+            WHERE entity_type = OLD.entity_type  AND  entity_id = OLD.entity_id  AND  key = OLD.key  AND  ts = OLD.ts;
+            RETURN OLD;
+        END IF;
+
+        INSERT INTO ts_kv_partitioned VALUES (NEW.*)
+        ON CONFLICT (entity_type, entity_id, key, ts) DO UPDATE SET
+            bool_v = excluded.bool_v, str_v = excluded.str_v, long_v = excluded.long_v, dbl_v = excluded.dbl_v;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS ts_kv_mirror ON ts_kv;
+    CREATE TRIGGER ts_kv_mirror AFTER INSERT OR UPDATE OR DELETE ON ts_kv FOR EACH ROW EXECUTE PROCEDURE ts_kv_mirror();
+    """
+
+# Copies the next batch of rows after the last key copied, and returns the last key in this batch along with how many rows it had
+COPY_BATCH = """
+    WITH batch AS (
+        SELECT * FROM ts_kv
+        WHERE (entity_type, entity_id, key, ts) > (%(entity_type)s, %(entity_id)s, %(key)s, %(ts)s)
+        ORDER BY entity_type, entity_id, key, ts
+        LIMIT %(limit)s
+    ),
+    copied AS (
+        INSERT INTO ts_kv_partitioned SELECT * FROM batch
+        ON CONFLICT (entity_type, entity_id, key, ts) DO NOTHING      -- Already mirrored by the trigger, which has the newer value
+    )
+    SELECT entity_type, entity_id, key, ts, (SELECT count(*) FROM batch)
+    FROM batch
+    ORDER BY entity_type DESC, entity_id DESC, key DESC, ts DESC
+    LIMIT 1
+    """
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert ts_kv into a table partitioned by month")
+    parser.add_argument("step", choices=["prepare", "copy", "swap", "create-partitions", "drop-before"])
+    parser.add_argument("month", nargs="?", help="For drop-before: the oldest month to keep, as YYYY-MM")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be done, but change nothing")
+    args = parser.parse_args()
+
+    if args.step == "drop-before" and not (args.month and re.fullmatch(r"\d{4}-(0[1-9]|1[0-2])", args.month)):
+        parser.error("drop-before needs a month as YYYY-MM, e.g. drop-before 2019-06")
+
+    con = None
+
+    try:
+        con = psycopg2.connect("dbname='thingsboard'")
+        with con.cursor() as cur:
+            cur.execute("SET lock_timeout = %s", (LOCK_TIMEOUT,))
+        con.commit()
+
+        if args.step == "prepare":
+            prepare(con, args.dry_run)
+        elif args.step == "copy":
+            copy_rows(con, args.dry_run)
+        elif args.step == "swap":
+            swap(con, args.dry_run)
+        elif args.step == "create-partitions":
+            create_partitions(con, get_partitioned_table(con), month_of(time.time() * 1000), args.dry_run)
+        elif args.step == "drop-before":
+            drop_partitions_before(con, args.month, args.dry_run)
+
+    except psycopg2.DatabaseError as e:
+        logging.error("Error partitioning ts_kv: %s" % e)
+
+    finally:
+        if con:
+            con.close()
+
+
+def execute(con, statement, params=None, dry_run=False):
+    if dry_run:
+        logging.info("Would run: %s" % (statement.as_string(con) if isinstance(statement, sql.Composable) else statement).strip())
+        return
+
+    with con.cursor() as cur:
+        cur.execute(statement, params)
+
+
+def month_of(ts):
+    """
+    Returns (year, month) in UTC for a timestamp in ms
+    """
+    date = datetime.datetime.utcfromtimestamp(ts / 1000)
+    return date.year, date.month
+
+
+def next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def month_start(year, month):
+    return int(datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+def partition_name(year, month):
+    return "ts_kv_%04d_%02d" % (year, month)
+
+
+def get_partitioned_table(con):
+    """
+    Returns the name of our partitioned table: ts_kv once we've swapped, ts_kv_partitioned until then.
+    """
+    with con.cursor() as cur:
+        cur.execute("SELECT relkind FROM pg_class WHERE relname = 'ts_kv' AND relnamespace = 'public'::regnamespace")
+        partitioned = cur.fetchone()[0] == "p"
+    con.commit()
+
+    return "ts_kv" if partitioned else NEW_TABLE
+
+
+def get_existing_partitions(con, table):
+    with con.cursor() as cur:
+        cur.execute("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = to_regclass(%s)", (table,))     # None if no table yet
+        names = {row[0] for row in cur.fetchall()}
+    con.commit()
+
+    return names
+
+
+def create_partitions(con, table, first_month, dry_run=False):
+    """
+    Creates a partition of table for every month from first_month until MONTHS_AHEAD months from now, skipping any that exist.
+    """
+    existing = get_existing_partitions(con, table)
+    year, month = first_month
+    last = month_of(time.time() * 1000)
+    for _ in range(MONTHS_AHEAD):
+        last = next_month(*last)
+
+    while (year, month) <= last:
+        name = partition_name(year, month)
+
+        if name not in existing:
+            create_partition(con, table, year, month, DEFAULT_PARTITION in existing, dry_run)
+
+        year, month = next_month(year, month)
+
+
+def create_partition(con, table, year, month, has_default, dry_run=False):
+    """
+    Creates the partition for one month.  Postgres won't create a partition while the default partition holds rows that belong in
+    it (rows from devices with bad clocks end up there), so any such rows are moved into the new partition in the same transaction.
+    """
+    name = partition_name(year, month)
+    bounds = (month_start(year, month), month_start(*next_month(year, month)))
+    strays = 0
+
+    if has_default:
+        with con.cursor() as cur:
+            cur.execute(sql.SQL("SELECT count(*) FROM {} WHERE ts >= %s AND ts < %s").format(sql.Identifier(DEFAULT_PARTITION)), bounds)
+            strays = cur.fetchone()[0]
+
+    if dry_run:
+        if strays:
+            logging.info("Would move %d rows for %d-%02d out of %s" % (strays, year, month, DEFAULT_PARTITION))
+        execute(con, sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)").format(sql.Identifier(name), sql.Identifier(table)),
+                bounds, dry_run)
+        con.commit()
+        return
+
+    try:
+        with con.cursor() as cur:
+            if strays:
+                cur.execute(sql.SQL("CREATE TEMP TABLE ts_kv_strays (LIKE {}) ON COMMIT DROP").format(sql.Identifier(DEFAULT_PARTITION)))
+                cur.execute(sql.SQL("WITH moved AS (DELETE FROM {} WHERE ts >= %s AND ts < %s RETURNING *) INSERT INTO ts_kv_strays SELECT * FROM moved")
+                            .format(sql.Identifier(DEFAULT_PARTITION)), bounds)
+
+            cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)").format(sql.Identifier(name), sql.Identifier(table)), bounds)
+
+            if strays:
+                cur.execute(sql.SQL("INSERT INTO {} SELECT * FROM ts_kv_strays").format(sql.Identifier(table)))
+        con.commit()
+
+    except psycopg2.DatabaseError as e:
+        con.rollback()
+        logging.error("Could not create partition %s for %d-%02d (%d rows for that month in %s): %s" % (name, year, month, strays, DEFAULT_PARTITION, e))
+        raise
+
+    logging.info("Created partition %s" % name + (", moving %d rows into it from %s" % (strays, DEFAULT_PARTITION) if strays else ""))
+
+
+def estimate_partition_sizes(con):
+    """
+    Estimates rows and bytes per month from a sample of ts_kv, scaled up using Postgres' own row count and size for the table.
+    """
+    with con.cursor() as cur:
+        cur.execute("SELECT reltuples::bigint, pg_total_relation_size('ts_kv') FROM pg_class WHERE oid = 'ts_kv'::regclass")
+        total_rows, total_bytes = cur.fetchone()
+
+        cur.execute("""
+            SELECT to_char(to_timestamp(ts / 1000) AT TIME ZONE 'UTC', 'YYYY_MM') AS month, count(*)
+            FROM ts_kv TABLESAMPLE SYSTEM (%s)
+            GROUP BY 1
+            ORDER BY 1
+            """, (SAMPLE_PERCENT,))
+        months = cur.fetchall()
+    con.commit()
+
+    sampled = sum(count for _, count in months)
+    if not sampled:
+        logging.info("ts_kv looks to be empty")
+        return
+
+    bytes_per_row = total_bytes / total_rows if total_rows > 0 else 0
+    logging.info("ts_kv: about %d rows, %.1f GB" % (total_rows, total_bytes / 1e9))
+
+    for month, count in months:
+        rows = count * total_rows / sampled
+        logging.info("    ts_kv_%s: about %d rows, %.1f MB" % (month, rows, rows * bytes_per_row / 1e6))
+
+
+def prepare(con, dry_run=False):
+    if dry_run:
+        estimate_partition_sizes(con)
+
+    with con.cursor() as cur:
+        # ts_kv is only indexed by device and key, so this is a full scan... but it only happens once, and only reads
+        cur.execute("SELECT min(ts) FROM ts_kv")
+        min_ts = cur.fetchone()[0]
+        cur.execute("SELECT tableowner FROM pg_tables WHERE tablename = 'ts_kv' AND schemaname = 'public'")
+        owner = cur.fetchone()[0]
+    con.commit()
+
+    first_month = month_of(min_ts if min_ts is not None else time.time() * 1000)
+    logging.info("ts_kv has data from %d-%02d onward" % first_month)
+
+    execute(con, sql.SQL("CREATE TABLE IF NOT EXISTS {} (LIKE ts_kv INCLUDING DEFAULTS, PRIMARY KEY (" + PRIMARY_KEY + ")) PARTITION BY RANGE (ts)")
+            .format(sql.Identifier(NEW_TABLE)), dry_run=dry_run)
+    execute(con, sql.SQL("ALTER TABLE {} OWNER TO {}").format(sql.Identifier(NEW_TABLE), sql.Identifier(owner)), dry_run=dry_run)
+    execute(con, sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT").format(sql.Identifier(DEFAULT_PARTITION), sql.Identifier(NEW_TABLE)),
+            dry_run=dry_run)
+    con.commit()
+
+    create_partitions(con, NEW_TABLE, first_month, dry_run)
+
+    execute(con, sql.SQL("CREATE TABLE IF NOT EXISTS {} (entity_type varchar(255), entity_id varchar(31), key varchar(255), ts bigint, copied bigint, finished boolean)")
+            .format(sql.Identifier(PROGRESS_TABLE)), dry_run=dry_run)
+    execute(con, sql.SQL("INSERT INTO {} SELECT '', '', '', -9223372036854775808, 0, false WHERE NOT EXISTS (SELECT 1 FROM {})")
+            .format(sql.Identifier(PROGRESS_TABLE), sql.Identifier(PROGRESS_TABLE)), dry_run=dry_run)
+    con.commit()
+
+    # The trigger has to be in place before we start copying, so nothing written in the meantime is missed
+    execute(con, MIRROR_TRIGGER, dry_run=dry_run)
+    con.commit()
+
+    if not dry_run:
+        logging.info("Prepared %s; now run copy" % NEW_TABLE)
+
+
+def copy_rows(con, dry_run=False):
+    with con.cursor() as cur:
+        cur.execute(sql.SQL("SELECT entity_type, entity_id, key, ts, copied FROM {}").format(sql.Identifier(PROGRESS_TABLE)))
+        entity_type, entity_id, key, ts, copied = cur.fetchone()
+    con.commit()
+
+    if dry_run:
+        logging.info("Would copy ts_kv rows after (%s, %s, %s, %s) in batches of %d; %d copied so far" % (entity_type, entity_id, key, ts, BATCH_SIZE, copied))
+        return
+
+    started = time.time()
+    copied_this_run = batches = 0
+
+    while True:
+        with con.cursor() as cur:
+            cur.execute(COPY_BATCH, {"entity_type": entity_type, "entity_id": entity_id, "key": key, "ts": ts, "limit": BATCH_SIZE})
+            row = cur.fetchone()
+
+            if row is None:
+                # Caught up; everything from here on is being mirrored by the trigger
+                cur.execute(sql.SQL("UPDATE {} SET finished = true").format(sql.Identifier(PROGRESS_TABLE)))
+                con.commit()
+                break
+
+            entity_type, entity_id, key, ts, count = row
+            copied += count
+            cur.execute(sql.SQL("UPDATE {} SET entity_type = %s, entity_id = %s, key = %s, ts = %s, copied = %s").format(sql.Identifier(PROGRESS_TABLE)),
+                        (entity_type, entity_id, key, ts, copied))
+        con.commit()
+
+        copied_this_run += count
+        batches += 1
+        if batches % 50 == 0:
+            elapsed = time.time() - started
+            logging.info("Copied %d rows (%.0f rows/sec), up to %s %s" % (copied, copied_this_run / elapsed if elapsed else 0, entity_id, key))
+
+        time.sleep(PAUSE_BETWEEN_BATCHES)
+
+    elapsed = time.time() - started
+    logging.info("Copy finished: %d rows this run in %.0f seconds (%.0f rows/sec); now run swap" %
+                 (copied_this_run, elapsed, copied_this_run / elapsed if elapsed else 0))
+
+
+def swap(con, dry_run=False):
+    statements = [
+        sql.SQL("LOCK TABLE ts_kv IN ACCESS EXCLUSIVE MODE"),
+        sql.SQL("DROP TRIGGER ts_kv_mirror ON ts_kv"),
+        sql.SQL("ALTER TABLE ts_kv RENAME TO {}").format(sql.Identifier(OLD_TABLE)),
+        sql.SQL("ALTER TABLE {} RENAME TO ts_kv").format(sql.Identifier(NEW_TABLE)),
+        sql.SQL("DROP FUNCTION ts_kv_mirror()"),
+        sql.SQL("DROP TABLE {}").format(sql.Identifier(PROGRESS_TABLE)),
+    ]
+
+    if not dry_run:
+        # Make sure the copy got to the end; anything written since has been mirrored by the trigger
+        with con.cursor() as cur:
+            cur.execute(sql.SQL("SELECT finished FROM {}").format(sql.Identifier(PROGRESS_TABLE)))
+            finished = cur.fetchone()[0]
+        con.commit()
+
+        if not finished:
+            logging.error("Copy isn't finished; run copy again before swapping")
+            return
+
+    for statement in statements:
+        execute(con, statement, dry_run=dry_run)
+    con.commit()
+
+    logging.info("ts_kv is now partitioned; the original table is %s" % OLD_TABLE)
+
+
+def drop_partitions_before(con, month, dry_run=False):
+    """
+    Drops every monthly partition of ts_kv for months before month (YYYY-MM).  This is how old data is thrown away now.
+    """
+    keep_from = partition_name(*(int(part) for part in month.split("-")))
+
+    for name in sorted(get_existing_partitions(con, get_partitioned_table(con))):
+        if name == DEFAULT_PARTITION or name >= keep_from:
+            continue
+
+        execute(con, sql.SQL("DROP TABLE {}").format(sql.Identifier(name)), dry_run=dry_run)
+        con.commit()
+
+        if not dry_run:
+            logging.info("Dropped partition %s" % name)
+
+
+if __name__ == "__main__":
+    main()
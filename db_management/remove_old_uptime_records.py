@@ -1,6 +1,11 @@
 #!/usr/bin/python
 import psycopg2  # pip install psycopg2-binary
 import logging
+import json
+import os
+import time
+
+from maintenance import vacuum_where_needed, MaintenanceMetrics
 
 # Run as user postgres
 
@@ -9,25 +14,52 @@ This script will delete any uptime data more than 30 days old, except those reco
     1) Immediately after a reboot
     2) Immediately prior to a device rebooting or being taken offline
 
+Work is done one device at a time, walking its uptime records in ts order a batch at a time, and committing after each batch, so
+locks on ts_kv are only ever held briefly.  Progress is saved after every batch; if the job is interrupted, or runs out of time,
+the next run picks up where it left off.
+
 To be run daily via cron
 """
 
 logging.basicConfig(filename="/var/log/db_maintenance.log", level=logging.DEBUG, format="%(asctime)s %(levelname)s %(message)s", datefmt="%d %b %Y %H:%M:%S")
 
-con = None
-rows = -1
+PROGRESS_FILE = "/var/tmp/remove_old_uptime_records.progress.json"
 
-con = psycopg2.connect("dbname='thingsboard'")
+BATCH_SIZE = 5000               # Rows examined per transaction
+PAUSE_BETWEEN_BATCHES = 0.1     # Seconds; give other writers a look-in
+MAX_RUNTIME = 60 * 60           # Seconds; stop here and let tomorrow's run carry on
+LOCK_TIMEOUT = "5s"             # Give up on a batch rather than queue behind a long-running lock
 
 
 def main():
     logging.info("Starting daily maintenance")
+    con = None
+    metrics = MaintenanceMetrics("remove_old_uptime_records")
+    success = False
 
     try:
-        rows = remove_uptime_records(con)
+        con = psycopg2.connect("dbname='thingsboard'")
+        with con.cursor() as cur:
+            cur.execute("SET lock_timeout = %s", (LOCK_TIMEOUT,))
+        con.commit()
+
+        metrics.record_table_sizes(con, "ts_kv%", "before")
+
+        with metrics.step("prune"):
+            examined, rows = remove_uptime_records(con)
+        metrics.count("rows_examined", examined)
+        metrics.count("rows_deleted", rows)
         logging.info("Deleted " + str(rows) + " uptime records")
-        vacuum(con, "ts_kv")
-        logging.info("Vacuum finished")
+
+        if rows:
+            with metrics.step("vacuum"):
+                metrics.record_vacuums(vacuum_where_needed(con, "ts_kv%"))
+            logging.info("Vacuum finished")
+        else:
+            logging.info("Nothing deleted; skipping vacuum")
+
+        metrics.record_table_sizes(con, "ts_kv%", "after")
+        success = True
 
     except psycopg2.DatabaseError as e:
         logging.error("Error removing useless uptime records: %s" % e)
@@ -35,60 +67,137 @@ def main():
     finally:
         if con:
             con.close()
+        metrics.write(success)
+
+
+def load_progress():
+    """
+    Returns {"cutoff": ts, "entities": {entity_id: [last_ts, last_value]}, "finished": [entity_id, ...]}, or None if there is no
+    unfinished run to resume.
+    """
+    try:
+        with open(PROGRESS_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_progress(progress):
+    # Write then rename, so an interruption can't leave us with half a file
+    temp_file = PROGRESS_FILE + ".tmp"
+    with open(temp_file, "w") as f:
+        json.dump(progress, f)
+    os.replace(temp_file, PROGRESS_FILE)
+
+
+def get_cutoff(con):
+    with con.cursor() as cur:
+        cur.execute("SELECT trunc(extract(epoch from (now() - interval '1 month')) * 1000)::bigint")      # Older than a month
+        return cur.fetchone()[0]
 
 
+def get_uptime_entities(con):
+    # ts_kv_latest has one row per device and key, so this is far cheaper than scanning ts_kv
+    with con.cursor() as cur:
+        cur.execute("SELECT DISTINCT entity_id FROM ts_kv_latest WHERE key = 'uptime' ORDER BY entity_id")
+        return [row[0] for row in cur.fetchall()]
+
+
+# Returns (rows examined, rows deleted)
 def remove_uptime_records(con):
-    cur = con.cursor()
-    cur.execute("""
-        WITH deletable AS (
-
-        SELECT t.*
-        FROM (  SELECT *,
-                    lead(long_v) over (partition by entity_id order by ts) as next_val,
-                    lag(long_v) over (partition by entity_id order by ts) as prev_val
-                FROM ts_kv
-                WHERE   key = 'uptime'
-                    AND
-                        ts < trunc(extract(epoch from (now() - interval '1 month')) * 1000)       -- Older than a month
-            ) AS t
+    started = time.time()
+    progress = load_progress()
+
+    if progress:
+        logging.info("Resuming uptime pruning, %d devices already finished" % len(progress["finished"]))
+    else:
+        progress = {"cutoff": get_cutoff(con), "entities": {}, "finished": []}
+
+    finished = set(progress["finished"])
+    total_examined = total_deleted = 0
+    complete = True
+
+    for entity_id in get_uptime_entities(con):
+        if entity_id in finished:
+            continue
+
+        if time.time() - started > MAX_RUNTIME:
+            logging.info("Out of time; will resume on the next run")
+            complete = False
+            break
+
+        examined, deleted = remove_entity_uptime_records(con, entity_id, progress)
+        total_examined += examined
+        total_deleted += deleted
 
-        WHERE long_v < next_val  -- delete where the next value is higher than this one... still growing!
-                AND              -- but only where...
-                long_v > prev_val limit 200000  -- we are not the lowest (use 200000 to keep chunks manageable; will become irrelevant when scheduled daily)
-        )
+        progress["finished"].append(entity_id)
+        progress["entities"].pop(entity_id, None)
+        save_progress(progress)
 
-        DELETE FROM ts_kv K
-        USING deletable
-        WHERE K.entity_id = deletable.entity_id  AND  K.key = 'uptime'  AND  K.ts = deletable.ts;
-        """)
+    elapsed = time.time() - started
+    logging.info("Examined %d and deleted %d uptime records in %.0f seconds (%.0f rows/sec)" %
+                 (total_examined, total_deleted, elapsed, total_examined / elapsed if elapsed else 0))
 
-    rows = cur.rowcount
-    con.commit()
+    if complete and os.path.exists(PROGRESS_FILE):
+        os.remove(PROGRESS_FILE)
 
-    return rows
+    return total_examined, total_deleted
 
 
-# Adapted from https://nessy.info/?p=886
-def vacuum(con, table):
+def remove_entity_uptime_records(con, entity_id, progress):
     """
-    Run vacuum on specified table
+    Walks entity_id's uptime records older than the cutoff in ts order, deleting any that are higher than the one before and lower than
+    the one after (i.e. uptime is still growing!).  Returns (rows examined, rows deleted).
     """
+    last_ts, prev_val = progress["entities"].get(entity_id, (-1, None))
+    examined = deleted = 0
+    started = time.time()
+
+    while True:
+        with con.cursor() as cur:
+            # Read one row beyond the batch, so we know what comes after the last row in it
+            cur.execute("""
+                SELECT ts, long_v
+                FROM ts_kv
+                WHERE entity_id = %s  AND  key = 'uptime'  AND  ts > %s  AND  ts < %s
+                ORDER BY ts
+                LIMIT %s
+                """, (entity_id, last_ts, progress["cutoff"], BATCH_SIZE + 1))
+            rows = cur.fetchall()
+
+            if len(rows) < 2:
+                con.rollback()
+                break
+
+            batch = rows[:-1]
+            deletable = []
+
+            for i, (ts, long_v) in enumerate(batch):
+                next_val = rows[i + 1][1]
+
+                if prev_val is not None and next_val is not None and long_v is not None and prev_val < long_v < next_val:
+                    deletable.append(ts)
+
+                prev_val = long_v
+
+            if deletable:
+                cur.execute("DELETE FROM ts_kv WHERE entity_id = %s  AND  key = 'uptime'  AND  ts = ANY(%s)", (entity_id, deletable))
+                deleted += cur.rowcount
 
-    query = "VACUUM %s" % table
+            con.commit()
 
-    # VACUUM can not run in a transaction block,
-    # which psycopg2 uses by default.
-    # http://bit.ly/1OUbYB3
-    isolation_level = con.isolation_level
-    con.set_isolation_level(0)
+        examined += len(batch)
+        last_ts = batch[-1][0]
+        progress["entities"][entity_id] = [last_ts, prev_val]
+        save_progress(progress)
 
-    cur = con.cursor()
-    cur.execute(query)
+        time.sleep(PAUSE_BETWEEN_BATCHES)
 
-    # Restore isolation_level
-    con.set_isolation_level(isolation_level)
+    elapsed = time.time() - started
+    if deleted:
+        logging.debug("%s: examined %d, deleted %d uptime records (%.0f rows/sec)" % (entity_id, examined, deleted, examined / elapsed if elapsed else 0))
 
-    return con.notices
+    return examined, deleted
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+# Copyright 2018, Chris Eykamp
+
+# MIT License
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+# Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Local record of what the importers (deq.py, purple.py) have already sent to Sensorbot.  For each station we keep the timestamp
+of the newest record uploaded (the "high-water mark"), and every (ts, key, value) we've recently written, so that a run can pick
+up where the last one left off without asking the server, and can skip data that hasn't changed since we last sent it.
+"""
+
+import sqlite3
+import threading
+import json
+import os
+import time
+from typing import List, Dict, Tuple, Any, Optional
+
+
+DAY = 24 * 60 * 60 * 1000
+
+# Default location for the database; importers can override this with checkpoint_db in their config file
+DEFAULT_CHECKPOINT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "importer_checkpoints.sqlite")
+
+# DEQ resends the current day and PurpleAir hands us the last month or so on every run; values older than this are of no use to us
+VALUE_RETENTION = 45 * DAY
+
+ValueIndex = Dict[Tuple[int, str], str]     # (ts, key) => value, as JSON
+
+
+def encode_value(value: Any) -> str:
+    return json.dumps(value)
+
+
+class CheckpointStore:
+    """
+    Thread-safe; a single store can be shared by importers processing several stations at once.  Payloads are in the
+    {"ts": ..., "values": {...}} format we send to the server.
+    """
+    def __init__(self, filename: str = DEFAULT_CHECKPOINT_DB):
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(filename, check_same_thread=False)
+        self.con.executescript("""
+            CREATE TABLE IF NOT EXISTS high_water (
+                source  TEXT    NOT NULL,
+                station TEXT    NOT NULL,
+                ts      INTEGER NOT NULL,
+                PRIMARY KEY (source, station)
+            );
+
+            CREATE TABLE IF NOT EXISTS written_values (
+                source  TEXT    NOT NULL,
+                station TEXT    NOT NULL,
+                ts      INTEGER NOT NULL,
+                key     TEXT    NOT NULL,
+                value   TEXT    NOT NULL,
+                PRIMARY KEY (source, station, ts, key)
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS cached_attributes (
+                source     TEXT    NOT NULL,
+                device_id  TEXT    NOT NULL,
+                attributes TEXT    NOT NULL,
+                fetched_at REAL    NOT NULL,
+                PRIMARY KEY (source, device_id)
+            );
+            """)
+
+
+    def get_high_water(self, source: str, station: str) -> Optional[int]:
+        """
+        Returns the timestamp (epoch ms) of the newest record we've uploaded for station, or None if we've never uploaded any.
+        """
+        with self.lock:
+            row = self.con.execute("SELECT ts FROM high_water WHERE source = ? AND station = ?", (source, station)).fetchone()
+
+        return row[0] if row else None
+
+
+    def set_high_water(self, source: str, station: str, ts: int) -> None:
+        """
+        Advance the high-water mark for station to ts.  The mark never moves backwards.
+        """
+        with self.lock:
+            self.con.execute("""
+                INSERT INTO high_water (source, station, ts) VALUES (?, ?, ?)
+                ON CONFLICT (source, station) DO UPDATE SET ts = MAX(ts, excluded.ts)
+                """, (source, station, ts))
+            self.con.commit()
+
+
+    def load_index(self, source: str, station: str, from_ts: int, to_ts: int) -> ValueIndex:
+        """
+        Returns everything we've written for station between from_ts and to_ts (inclusive), fetched in a single query.
+        """
+        with self.lock:
+            rows = self.con.execute("SELECT ts, key, value FROM written_values WHERE source = ? AND station = ? AND ts BETWEEN ? AND ?",
+                                    (source, station, from_ts, to_ts)).fetchall()
+
+        return {(ts, key): value for ts, key, value in rows}
+
+
+    def filter_changed(self, source: str, station: str, payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Returns only those payloads we haven't uploaded before, or where any of the values differ from what we uploaded.
+        """
+        index = self.load_payload_index(source, station, payloads)
+
+        return [payload for payload in payloads
+                if any(index.get((payload["ts"], key)) != encode_value(value) for key, value in payload["values"].items())]
+
+
+    def drop_repeats(self, source: str, station: str, payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Finer-grained than filter_changed: strips every (ts, key, value) we've already written from payloads, so a partially
+        changed record is sent with only its changed keys.  Payloads left with nothing to send are dropped entirely.
+        """
+        index = self.load_payload_index(source, station, payloads)
+        deduped: List[Dict[str, Any]] = []
+
+        for payload in payloads:
+            ts = payload["ts"]
+            values = {key: value for key, value in payload["values"].items() if index.get((ts, key)) != encode_value(value)}
+
+            if values:
+                deduped.append({"ts": ts, "values": values})
+
+        return deduped
+
+
+    def load_payload_index(self, source: str, station: str, payloads: List[Dict[str, Any]]) -> ValueIndex:
+        if not payloads:
+            return {}
+
+        timestamps = [payload["ts"] for payload in payloads]
+
+        return self.load_index(source, station, min(timestamps), max(timestamps))
+
+
+    def remember(self, source: str, station: str, payloads: List[Dict[str, Any]]) -> None:
+        """
+        Record that payloads were successfully uploaded, and advance the station's high-water mark accordingly.
+        """
+        if not payloads:
+            return
+
+        newest = max(payload["ts"] for payload in payloads)
+        rows = [(source, station, payload["ts"], key, encode_value(value)) for payload in payloads for key, value in payload["values"].items()]
+
+        with self.lock:
+            self.con.executemany("INSERT OR REPLACE INTO written_values (source, station, ts, key, value) VALUES (?, ?, ?, ?, ?)", rows)
+            self.con.execute("DELETE FROM written_values WHERE source = ? AND station = ? AND ts < ?", (source, station, newest - VALUE_RETENTION))
+            self.con.commit()
+
+        self.set_high_water(source, station, newest)
+
+
+    def load_attributes(self, source: str, max_age: float) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns {device_id: {key: value}} for every device whose attributes we cached less than max_age seconds ago, in one query.
+        """
+        with self.lock:
+            rows = self.con.execute("SELECT device_id, attributes FROM cached_attributes WHERE source = ? AND fetched_at > ?",
+                                    (source, time.time() - max_age)).fetchall()
+
+        return {device_id: json.loads(attributes) for device_id, attributes in rows}
+
+
+    def save_attributes(self, source: str, device_id: str, attributes: Dict[str, Any]) -> None:
+        with self.lock:
+            self.con.execute("INSERT OR REPLACE INTO cached_attributes (source, device_id, attributes, fetched_at) VALUES (?, ?, ?, ?)",
+                             (source, device_id, json.dumps(attributes), time.time()))
+            self.con.commit()
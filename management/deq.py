@@ -24,6 +24,9 @@ import os
 import sys
 import datetime
 import time
+import threading
+import concurrent.futures
+import random
 # import pytz                                                       # pip install pytz
 import logging
 from dateutil import parser                                         # pip install python-dateutil
@@ -32,13 +35,18 @@ from config import thingsboard_username, thingsboard_password, deq_logfile   # Y
 # from config import thingsboard_username, thingsboard_password   # You'll need to create this... Be sure to gitignore it!
 import config
 import birdhouse_utils
-from typing import List, Any
+from checkpoint_store import CheckpointStore, DEFAULT_CHECKPOINT_DB
+from typing import List, Dict, Tuple, Any, Iterator, Callable, Optional
 # from dateutil.parser import parse
 
 
 mothership_url = birdhouse_utils.make_mothership_url(config=config)
 tbapi = TbApi(mothership_url, thingsboard_username, thingsboard_password)
 
+# Our local record of what we've already uploaded
+checkpoints = CheckpointStore(getattr(config, "checkpoint_db", DEFAULT_CHECKPOINT_DB))
+CHECKPOINT_SOURCE = "deq"
+
 logging.basicConfig(filename=deq_logfile, format='%(asctime)s %(message)s', level=logging.INFO)    # WARN, INFO, DEBUG
 
 # Data is stored as if it were coming from one of our devices
@@ -65,6 +73,41 @@ SECOND = 1000
 MINUTE = 60 * SECOND
 HOUR = 60 * MINUTE
 
+# Upload tuning.  Records are sent to the server in batches; the delay between batches adapts to how well the server is keeping up.
+UPLOAD_BATCH_SIZE = 250         # Max records per send_telemetry call
+MIN_UPLOAD_DELAY = 0.05         # Seconds between batches when all is well
+MAX_UPLOAD_DELAY = 30           # If we need to back off further than this, give up
+
+# Stations are processed concurrently, but we limit how hard we hit each host at any one time
+MAX_STATION_WORKERS = 4         # Stations in flight at once
+DEQ_HOST_CONCURRENCY = 2        # Simultaneous requests to the DEQ server, which is flaky enough already
+SERVER_HOST_CONCURRENCY = 4     # Simultaneous requests to Sensorbot
+
+deq_host_limit = threading.BoundedSemaphore(DEQ_HOST_CONCURRENCY)
+server_host_limit = threading.BoundedSemaphore(SERVER_HOST_CONCURRENCY)
+
+# DEQ requests fail pretty regularly, so we retry them.  Long ranges are split into chunks that are fetched (and retried) separately.
+FETCH_ATTEMPTS = 4              # Tries per request before giving up
+FETCH_BACKOFF_BASE = 2          # Seconds; doubles with each failed attempt, and we wait a random amount up to that (jitter)
+FETCH_BACKOFF_MAX = 60          # Never wait longer than this between attempts
+FETCH_CHUNK_DAYS = 1            # Size of the chunks we split long ranges into
+CIRCUIT_BREAKER_THRESHOLD = 5   # After this many consecutive failures, give up on the station for the rest of the run
+BACKFILL_WINDOW_DAYS = 7        # In --backfill mode, each window is fetched, uploaded and checkpointed before we move on
+
+
+# This is the earliest timestamp we're interested in.  The first time we run this script, all data since this date will be imported.
+# Making the date unnecessarily early will make this script run very slowly.  Note also that if the date is too early, the DEQ server will
+# not respond properly.  Since we have different dates for different stations (depending on when they came online), we'll specify them below.
+# These dates were chosen by trial and error.
+
+# Note -- when adding an item here make sure the device has been defined on the server!
+STATIONS = [
+    # DEQ id, device name, earliest_ts
+    (2,  "DEQ (SEL)", "2018/04/28T00:00"),      # 2  => SE Lafayette (SEL)               [latitude:45.496640911, longitude:-122.60287735]
+    (64, "DEQ (PCH)", "2018/04/28T00:00"),      # 64 => Portland Cully Helensview (PCH)  [latitude:45.562203,    longitude:-122.575624]
+    (78, "DEQ (HUM)", "2019/06/28T00:00"),      # 78 => Portland Humboldt (HUM)          [latitude:45.558081,    longitude:-122.670985]
+]
+
 
 def main():
 
@@ -73,15 +116,29 @@ def main():
         # test("DEQ (PCH)", 64, "2020/01/24T00:00", "2020/01/30T00:01")
 
     else:
-        # This is the earliest timestamp we're interested in.  The first time we run this script, all data since this date will be imported.
-        # Making the date unnecessarily early will make this script run very slowly.  Note also that if the date is too early, the DEQ server will
-        # not respond properly.  Since we have different dates for different stations (depending on when they came online), we'll specify them below.
-        # These dates were chosen by trial and error.
+        run_stations(STATIONS, backfill="--backfill" in sys.argv[1:])
+
+
+def run_stations(stations: List[Tuple[int, str, str]], backfill: bool = False) -> None:
+    """
+    Retrieve and upload data for all stations concurrently, so a run takes about as long as the slowest station rather than the sum
+    of all of them.  A failure at one station doesn't stop the others; once everything has finished, the first failure is re-raised
+    so cron still sees it.
+    """
+    errors: List[Exception] = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_STATION_WORKERS) as executor:
+        futures = {executor.submit(get_data_for_station, *station, backfill=backfill): station for station in stations}
 
-        # Note -- when adding an item here make sure the device has been defined on the server!
-        get_data_for_station(2,  "DEQ (SEL)", "2018/04/28T00:00")   # 2  => SE Lafayette (SEL)               [latitude:45.496640911, longitude:-122.60287735]
-        get_data_for_station(64, "DEQ (PCH)", "2018/04/28T00:00")   # 64 => Portland Cully Helensview (PCH)  [latitude:45.562203,    longitude:-122.575624]
-        get_data_for_station(78, "DEQ (HUM)", "2019/06/28T00:00")   # 78 => Portland Humboldt (HUM)          [latitude:45.558081,    longitude:-122.670985]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as ex:
+                logging.error("Error processing station %s: %s" % (futures[future][1], ex))
+                errors.append(ex)
+
+    if errors:
+        raise errors[0]
 
 
 def test(device_name: str, deq_station_id: int, from_time: str, to_time: str):
@@ -124,7 +181,7 @@ def test(device_name: str, deq_station_id: int, from_time: str, to_time: str):
     pass
 
 
-def get_data_for_station(station_id: int, device_name: str, earliest_ts: str) -> None:
+def get_data_for_station(station_id: int, device_name: str, earliest_ts: str, backfill: bool = False) -> None:
     print_if_console("Retrieving data for %s..." % device_name)
 
     device = get_device(device_name)
@@ -135,61 +192,259 @@ def get_data_for_station(station_id: int, device_name: str, earliest_ts: str) ->
     from_ts = get_from_ts(device, earliest_ts)           # Our latest and value, or earliest_ts if this is the inaugural run
     to_ts   = make_deq_date_from_ts(int(time.time() * 1000) + 24 * HOUR)    # 24 hours from now, to protect against running in other timezones
 
-    # Fetch the data from DEQ
-    print_if_console(f"\tRetrieving data from DEQ ({from_ts.replace('T', ' ')} - {to_ts.replace('T', ' ')})")
-    try:
-        station_records: List[StationRecord] = deq_tools.get_data(station_id, from_ts, to_ts)
-    except Exception as ex:
-        logging.warning("Error retrieving data")
-        logging.warning(ex)
-
-        # Swallow exception until things have been down awhile... DEQ servers fail from time to time.  Pretty regularly, actually.
-        time_since_last_data = datetime.datetime.fromtimestamp(time.time()) - parser.parse(from_ts)  # gives timedelta
-        if time_since_last_data > datetime.timedelta(hours=12):
-            logging.error("Persistent error retrieving data (%s)" % str(time_since_last_data))
-
-            raise ex
-        else:
-            logging.info("DEQ connection failure; last data %s / %s / %s" % (time_since_last_data, from_ts, to_ts))
-            return
-
-    print_if_console("\tUploading data to Sensorbot...")
+    if backfill:
+        records = backfill_station(station_id, device, from_ts, to_ts)
+    else:
+        # Fetch the data from DEQ
+        print_if_console(f"\t{device_name}: Retrieving data from DEQ ({from_ts.replace('T', ' ')} - {to_ts.replace('T', ' ')})")
+        try:
+            station_records, _ = fetch_range(station_id, from_ts, to_ts)
+        except Exception as ex:
+            logging.warning("Error retrieving data")
+            logging.warning(ex)
+
+            # Swallow exception until things have been down awhile... DEQ servers fail from time to time.  Pretty regularly, actually.
+            time_since_last_data = datetime.datetime.fromtimestamp(time.time()) - parser.parse(from_ts)  # gives timedelta
+            if time_since_last_data > datetime.timedelta(hours=12):
+                logging.error("Persistent error retrieving data (%s)" % str(time_since_last_data))
+
+                raise ex
+            else:
+                logging.info("DEQ connection failure; last data %s / %s / %s" % (time_since_last_data, from_ts, to_ts))
+                return
+
+        print_if_console(f"\t{device_name}: Uploading data to Sensorbot...")
+        records = upload_station_records(device, station_records)
+
+    elapsed = time.time() - start
+    logging.info("Uploaded %s records for station %s in %s seconds (%s records/sec)" % (records, station_id, round(elapsed, 1), round(records / elapsed, 1)))
+    print_if_console("%s: Uploaded %s records in %s seconds (%s records/sec)" % (device_name, records, round(elapsed, 1), round(records / elapsed, 1)))
+
+
+def backfill_station(station_id: int, device: Device, from_ts: str, to_ts: str) -> int:
+    """
+    Work through from_ts - to_ts one window at a time, uploading and checkpointing each window before fetching the next.  Memory use
+    stays flat no matter how long the range is, and an interrupted backfill resumes from the last checkpoint the next time it runs.
+    Returns the number of records uploaded.
+    """
     records = 0
 
-    for station_record in station_records:
+    for window_from, window_to in split_range(from_ts, to_ts, BACKFILL_WINDOW_DAYS):
+        print_if_console(f"\t{device.name}: Backfilling {window_from.replace('T', ' ')} - {window_to.replace('T', ' ')}")
+
+        station_records, complete = fetch_range(station_id, window_from, window_to)
+        records += upload_station_records(device, station_records)
 
-        outgoing_data = {}
+        if not complete:
+            logging.warning("Backfill of station %s stopped partway through %s - %s; it will resume from there next run" % (station_id, window_from, window_to))
+            break
 
-        for channel in station_record.channels:
-            # print(channel)
-            # Assemble our payload, including translating names from DEQ's convention to ours
-            # DEQ stations report a lot of data, but the only items we're interested in are those listed in key_mapping
-            if channel.display_name in key_mapping and channel.valid:
-                our_key = key_mapping[channel.display_name]
-                outgoing_data[our_key] = channel.value
+    return records
 
-        if not outgoing_data:       # Will probably never happen
-            continue
 
-        records += 1
-        ts = int(station_record.datetime.timestamp() * 1000)
+def upload_station_records(device: Device, station_records: List[StationRecord]) -> int:
+    """
+    Upload station_records, skipping any values we've already sent, and checkpoint each batch as the server accepts it.
+    """
+    # Note that the DEQ now seems to be ignoring the time part of the requested timestamps, and is returning the entire day's worth of data.
+    # We check each (ts, key, value) against our checkpoint store, and only upload values that are new or have changed.
+    payloads = checkpoints.drop_repeats(CHECKPOINT_SOURCE, device.name, make_payloads(station_records))
+
+    return upload_payloads(device, payloads, lambda batch: checkpoints.remember(CHECKPOINT_SOURCE, device.name, batch))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive failed requests for a station.  Once there have been too many, the breaker opens and we stop sending
+    requests for that station, rather than piling more retries onto a server that clearly isn't answering.
+    """
+    def __init__(self, threshold: int):
+        self.threshold = threshold
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        with self.lock:
+            return self.failures >= self.threshold
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+
+
+def fetch_with_retry(station_id: int, from_ts: str, to_ts: str, breaker: CircuitBreaker) -> List[StationRecord]:
+    """
+    Fetch data from DEQ, retrying failures with exponential backoff and jitter.  Raises the last error if all attempts fail, or
+    CircuitOpenError if the station's breaker has opened.
+    """
+    attempt = 0
+
+    while True:
+        if breaker.is_open():
+            raise CircuitOpenError(f"Too many consecutive failures retrieving data for station {station_id}")
 
         try:
-            print_if_console(f"\r\tUploading {records} of {len(station_records)}", end="", flush=True)
-            device.send_telemetry(outgoing_data, ts)
-            time.sleep(.1)  # Throttle just a little
+            with deq_host_limit:
+                station_records: List[StationRecord] = deq_tools.get_data(station_id, from_ts, to_ts)
+
+            breaker.record_success()
+            return station_records
+
         except Exception as ex:
-            logging.warning("Error sending telemetry (%s)" % outgoing_data)
+            breaker.record_failure()
+            attempt += 1
+
+            if attempt >= FETCH_ATTEMPTS:
+                raise
+
+            delay = random.uniform(0, min(FETCH_BACKOFF_MAX, FETCH_BACKOFF_BASE * 2 ** (attempt - 1)))
+            logging.warning("Error retrieving data for station %s (%s - %s), attempt %s; retrying in %s seconds" % (station_id, from_ts, to_ts, attempt, round(delay, 1)))
             logging.warning(ex)
-            raise
+            time.sleep(delay)
+
+
+def split_range(from_ts: str, to_ts: str, days: int) -> Iterator[Tuple[str, str]]:
+    """
+    Split the range from_ts - to_ts (DEQ format) into chunks of the specified number of days, generated lazily.  DEQ returns whole
+    days regardless of the time we ask for, so each chunk ends at 23:59 on its last day and the next starts on a new date; that way
+    no day is requested twice.
+    """
+    start = datetime.datetime.strptime(from_ts, "%Y/%m/%dT%H:%M")
+    end = datetime.datetime.strptime(to_ts, "%Y/%m/%dT%H:%M")
+    minute = datetime.timedelta(minutes=1)
+
+    while start < end:
+        chunk_end = min(datetime.datetime.combine(start.date(), datetime.time()) + datetime.timedelta(days=days) - minute, end)
+        yield start.strftime("%Y/%m/%dT%H:%M"), chunk_end.strftime("%Y/%m/%dT%H:%M")
+        start = chunk_end + minute
+
+
+def fetch_range(station_id: int, from_ts: str, to_ts: str) -> Tuple[List[StationRecord], bool]:
+    """
+    Fetch a possibly long range from DEQ as a series of day-sized chunks, retrieved in parallel and retried independently.  If some
+    chunks still fail, we return the records from the chunks before the first failure, so we never leave a gap behind our
+    high-water mark; the rest will be picked up on the next run.  Raises if the very first chunk fails.  Returns the records,
+    and whether the whole range was retrieved.
+    """
+    breaker = CircuitBreaker(CIRCUIT_BREAKER_THRESHOLD)
+    chunks = list(split_range(from_ts, to_ts, FETCH_CHUNK_DAYS))
+    complete = True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DEQ_HOST_CONCURRENCY) as executor:
+        futures = [executor.submit(fetch_with_retry, station_id, chunk_from, chunk_to, breaker) for chunk_from, chunk_to in chunks]
+
+        station_records: List[StationRecord] = []
+
+        for i, ((chunk_from, chunk_to), future) in enumerate(zip(chunks, futures)):
+            try:
+                station_records += future.result()
+            except Exception as ex:
+                # Either way we're done with this range, so don't let the executor sit out the downloads still queued
+                for remaining in futures:
+                    remaining.cancel()
+
+                if i == 0:
+                    raise
+
+                logging.warning("Could not retrieve data for station %s (%s - %s); stopping there for this run" % (station_id, chunk_from, chunk_to))
+                logging.warning(ex)
+
+                complete = False
+                break
+
+    return sorted(station_records, key=lambda station_record: station_record.datetime), complete
+
+
+def make_channel_plan(channels: List[Any]) -> List[Tuple[int, str, str]]:
+    """
+    Returns (position, DEQ name, our key) for each channel we're interested in.  DEQ stations report a lot of data, but the only
+    items we care about are those listed in key_mapping.
+    """
+    return [(i, channel.display_name, key_mapping[channel.display_name]) for i, channel in enumerate(channels) if channel.display_name in key_mapping]
+
+
+def make_payloads(station_records: List[StationRecord]) -> List[Dict[str, Any]]:
+    """
+    Translate DEQ records into the list of {"ts": ..., "values": {...}} payloads the server accepts in a single telemetry post.
+
+    Records for a station all share the same channel layout, so rather than checking every channel of every record against
+    key_mapping, we work out once which positions hold the channels we want and pull just those from each record.  If a record's
+    layout doesn't match the plan, we make a new one.
+    """
+    payloads: List[Dict[str, Any]] = []
+    plan: List[Tuple[int, str, str]] = []
+    plan_length = -1
+
+    for station_record in station_records:
+        channels = station_record.channels
+
+        if len(channels) != plan_length or any(channels[i].display_name != name for i, name, _ in plan):
+            plan = make_channel_plan(channels)
+            plan_length = len(channels)
+
+        values = {our_key: channels[i].value for i, _, our_key in plan if channels[i].valid}
+
+        if not values:       # Will probably never happen
+            continue
+
+        payloads.append({"ts": int(station_record.datetime.timestamp() * 1000), "values": values})
+
+    return payloads
+
+
+def make_batches(items: List[Any], batch_size: int) -> Iterator[List[Any]]:
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+def upload_payloads(device: Device, payloads: List[Dict[str, Any]], on_batch_sent: Optional[Callable[[List[Dict[str, Any]]], None]] = None) -> int:
+    """
+    Send payloads to the server UPLOAD_BATCH_SIZE records at a time.  Rather than sleeping a fixed amount after every record, we
+    adapt: when a batch fails we double the delay and try it again, and every success halves the delay (down to MIN_UPLOAD_DELAY).
+    Raises if the server is still refusing our data after backing off to MAX_UPLOAD_DELAY.  If provided, on_batch_sent is called
+    with each batch once the server has accepted it.  Returns the number of records sent.
+    """
+    delay = MIN_UPLOAD_DELAY
+    sent = 0
+    start = time.time()
+
+    for batch in make_batches(payloads, UPLOAD_BATCH_SIZE):
+        while True:
+            try:
+                with server_host_limit:
+                    device.send_telemetry(batch)
+                break
+            except Exception as ex:
+                delay *= 2
+                logging.warning("Error sending telemetry batch of %s records; retrying in %s seconds" % (len(batch), round(delay, 2)))
+                logging.warning(ex)
+
+                if delay > MAX_UPLOAD_DELAY:
+                    raise
+
+                time.sleep(delay)
+
+        if on_batch_sent:
+            on_batch_sent(batch)
+
+        sent += len(batch)
+        delay = max(delay / 2, MIN_UPLOAD_DELAY)
+
+        rate = sent / max(time.time() - start, 0.001)
+        print_if_console(f"\r\t{device.name}: Uploaded {sent} of {len(payloads)} ({round(rate, 1)} records/sec)", end="", flush=True)
+        time.sleep(delay)
 
     print_if_console("")
 
-    # Note that the DEQ now seems to be ignoring the time part of the requested timestamps, and is returning the entire day's worth of data.
-    # This is not really a problem, because when inserting records with the same datestamp, the new data will overwrite the old, and no
-    # duplicate records will be created.  It's just ugly.
-    logging.info("Uploaded %s records for station %s in %s seconds" % (records, station_id, round(time.time() - start, 1)))
-    print_if_console("Uploaded %s records in %s seconds" % (records, round(time.time() - start, 1)))
+    return sent
 
 
 def make_date(deq_date: str) -> datetime.datetime:
@@ -212,7 +467,9 @@ def print_if_console(msg: str, **kwargs: Any) -> None:
 
 
 def get_device(device_name: str) -> Device:
-    device = tbapi.get_device_by_name(device_name)
+    with server_host_limit:
+        device = tbapi.get_device_by_name(device_name)
+
     if not device:
         raise Exception("Could not find device " + device_name + " in Sensorbot database!")
 
@@ -230,8 +487,14 @@ def get_from_ts(device: Device, earliest_ts: str) -> str:
     # ts for the most recently inserted DEQ data, or if data hasn't yet been inserted, it will return the value we set in
     # earliest_ts at the top of this file.  Returns date in 2020/11/02T04:34 format.
     # We add 1 minute to return time to avoid retrieving data we already have
+    # We look in our local checkpoint store first, and only ask the server if we have no local record for this station.
     """
-    telemetry = device.get_latest_telemetry(KEY_FOR_CHECKING_LAST_TELEMETRY_DATE)
+    ts = checkpoints.get_high_water(CHECKPOINT_SOURCE, device.name)
+    if ts is not None:
+        return make_deq_date_from_ts(ts + 1 * MINUTE)
+
+    with server_host_limit:
+        telemetry = device.get_latest_telemetry(KEY_FOR_CHECKING_LAST_TELEMETRY_DATE)
 
     if telemetry[KEY_FOR_CHECKING_LAST_TELEMETRY_DATE][0]["value"] is None:      # We haven't stored any telemetry yet
         logging.info("First run!")
@@ -1,17 +1,24 @@
 import requests
-import json
 import re
 import datetime, time
 import pytz
 import sys
 from datetime import datetime
 from pytz import timezone
-import calendar
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+try:
+    import ijson        # pip install ijson -- optional, lets us stream PurpleAir's huge sensor list rather than load it all at once
+except ModuleNotFoundError:
+    ijson = None
 
 # pip install git+git://github.com/eykamp/thingsboard_api_tools.git --upgrade
 # sudo pip install git+git://github.com/eykamp/thingsboard_api_tools.git --upgrade
 from thingsboard_api_tools import TbApi
 from provision_config import motherShipUrl, username, password
+import provision_config
+from checkpoint_store import CheckpointStore, DEFAULT_CHECKPOINT_DB
 
 # Bounding box that roughly defines Portland
 ll = (45.374361, -122.857000)
@@ -20,6 +27,30 @@ ur = (45.637960, -122.399479)
 
 tbapi = TbApi(motherShipUrl, username, password)
 
+# Our local record of what we've already uploaded, so we only send new or changed rows
+checkpoints = CheckpointStore(getattr(provision_config, "checkpoint_db", DEFAULT_CHECKPOINT_DB))
+CHECKPOINT_SOURCE = "purpleair"
+
+THINGSPEAK_PAGE_SIZE = 8000     # Max rows ThingSpeak will return per request
+FETCH_WORKERS = 8               # Stations fetched at once
+UPLOAD_BATCH_SIZE = 1000        # Max records per send_telemetry call
+ATTRIBUTE_CACHE_TTL = 7 * 24 * 60 * 60     # Seconds we trust our cached copy of a station's server attributes
+
+REQUIRED_ATTRIBUTES = ["primary_foreign_id", "primary_foreign_key", "secondary_foreign_id", "secondary_foreign_key"]
+
+# "field1":"PM1.0 (ATM)","field2":"PM2.5 (ATM)","field3":"PM10.0 (ATM)","field4":"Uptime","field5":"RSSI","field6":"Temperature","field7":"Humidity"
+PRIMARY_FIELDS = "12367"
+FIELD_MAPPING = {
+    "field1": "pm1",
+    "field2": "pm25",
+    "field3": "pm10",
+    "field6": "temperature",
+    "field7": "humidity",
+}
+
+# One pooled session for all our ThingSpeak and PurpleAir traffic, so requests reuse keep-alive connections
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS))
 
 update_station_list = False
 
@@ -39,90 +70,145 @@ def main():
         known_stations = tbapi.get_devices_by_name("PurpleAir")     # Freshen the list since we may have added some new stations
 
         
-    ctr = 0
+    # Foreign keys almost never change, so we cache them locally rather than asking the server for each station on every run
+    cached_attributes = checkpoints.load_attributes(CHECKPOINT_SOURCE, ATTRIBUTE_CACHE_TTL)
+    uncached = [device for device in known_stations if device["id"]["id"] not in cached_attributes]
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        for device, attributes in zip(uncached, executor.map(get_server_attributes, uncached)):
+            cached_attributes[device["id"]["id"]] = attributes
+
+    stations = []
 
     for device in known_stations:
-        print(device)
-        # s ==> {'id': {'entityType': 'DEVICE', 'id': 'c95d1850-53ce-11e8-8563-9d9c1f00510b'}, 'createdTime': 1525900824149, 'additionalInfo': None, 'tenantId': {'entityType': 'TENANT', 'id': '77e06cd0-9d84-11e7-9007-5108c78814ce'}, 'customerId': {'entityType': 'CUSTOMER', 'id': '13814000-1dd2-11b2-8080-808080808080'}, 'name': 'PurpleAir 7274', 'type': 'PurpleAir'}
-        attribs = tbapi.get_server_attributes(device)
-        # attribs ==> [{'lastUpdateTs': 1525900824336, 'key': 'latitude', 'value': 45.522683}, {'lastUpdateTs': 1525900824336, 'key': 'longitude', 'value': -122.639815}, {'lastUpdateTs': 1525900824336, 'key': 'primary_foreign_id', 'value': '421294'}, {'lastUpdateTs': 1525900824336, 'key': 'primary_foreign_key', 'value': 'S93EJNPS5Z4A5SL7'}, {'lastUpdateTs': 1525900824336, 'key': 'secondary_foreign_id', 'value': '421297'}, {'lastUpdateTs': 1525900824336, 'key': 'secondary_foreign_key', 'value': 'XHC0MXLQYDYEAYUO'}]
-
-        ts_id, ts_key, ts_id_2, ts_key_2 = None, None, None, None
-
-        token = tbapi.get_device_token(device)
-
-        for attrib in attribs:
-            if attrib["key"] == "primary_foreign_id":
-                ts_id = attrib["value"]
-            elif attrib["key"] == "primary_foreign_key":
-                ts_key = attrib["value"]
-            elif attrib["key"] == "secondary_foreign_id":
-                ts_id_2 = attrib["value"]
-            elif attrib["key"] == "secondary_foreign_key":
-                ts_key_2 = attrib["value"]
-
-        if ts_id is None or ts_key is None or ts_id_2 is None or ts_key_2 is None:
+        attributes = cached_attributes[device["id"]["id"]]
+
+        if any(attributes.get(key) is None for key in REQUIRED_ATTRIBUTES):
             print("Could not find required key for device", device)
             exit()
 
+        stations.append((device, attributes["primary_foreign_id"], attributes["primary_foreign_key"]))
+
+    # Stations are independent, so fetch and upload several at once
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        for (device, _, _), sent in zip(stations, executor.map(lambda station: import_station(*station), stations)):
+            print(device["name"], "uploaded", sent, "records")
+
+    # https://www.purpleair.com/json?show=s["ID"]  -- Basic info
+    # https://api.thingspeak.com/channels/421294/fields/123456789.json?offset=0&round=2&average=10&results=4800&api_key=S93EJNPS5Z4A5SL7
+
 
-        # "field1":"PM1.0 (ATM)","field2":"PM2.5 (ATM)","field3":"PM10.0 (ATM)","field4":"Uptime","field5":"RSSI","field6":"Temperature","field7":"Humidity"
-        fields_wanted = "12367"
-        req = requests.get("https://api.thingspeak.com/channels/" + ts_id + "/fields/" + fields_wanted + ".json?offset=0&round=2&average=10&results=4800&api_key=" + ts_key)
-        data = json.loads(req.text)
-        feeds = data["feeds"]
-        payloads = []
-        for f in feeds:
-            # '2018-05-05T14:10:00Z'
-            ts_utc = calendar.timegm(time.strptime(f["created_at"], "%Y-%m-%dT%H:%M:%SZ")) * 1000
-            values = {}
-            if f["field1"] is not None:
-                values["pm1"] = float(f["field1"])
-            if f["field2"] is not None:
-                values["pm25"] = float(f["field2"])
-            if f["field3"] is not None:
-                values["pm10"] = float(f["field3"])
-            if f["field6"] is not None:
-                values["temperature"] = float(f["field6"])
-            if f["field7"] is not None:
-                values["humidity"] = float(f["field7"])
-
-            if len(values) > 0:
-                payload = {"ts":ts_utc, "values":values}
-                payloads.append(payload)
+def get_server_attributes(device):
+    """
+    Fetch device's server attributes as a {key: value} dict, and cache them if they include everything we need.
+    """
+    # device ==> {'id': {'entityType': 'DEVICE', 'id': 'c95d1850-53ce-11e8-8563-9d9c1f00510b'}, 'createdTime': 1525900824149, 'additionalInfo': None, 'tenantId': {'entityType': 'TENANT', 'id': '77e06cd0-9d84-11e7-9007-5108c78814ce'}, 'customerId': {'entityType': 'CUSTOMER', 'id': '13814000-1dd2-11b2-8080-808080808080'}, 'name': 'PurpleAir 7274', 'type': 'PurpleAir'}
+    attribs = tbapi.get_server_attributes(device)
+    # attribs ==> [{'lastUpdateTs': 1525900824336, 'key': 'latitude', 'value': 45.522683}, {'lastUpdateTs': 1525900824336, 'key': 'longitude', 'value': -122.639815}, {'lastUpdateTs': 1525900824336, 'key': 'primary_foreign_id', 'value': '421294'}, {'lastUpdateTs': 1525900824336, 'key': 'primary_foreign_key', 'value': 'S93EJNPS5Z4A5SL7'}, {'lastUpdateTs': 1525900824336, 'key': 'secondary_foreign_id', 'value': '421297'}, {'lastUpdateTs': 1525900824336, 'key': 'secondary_foreign_key', 'value': 'XHC0MXLQYDYEAYUO'}]
+
+    attributes = {attrib["key"]: attrib["value"] for attrib in attribs}
+
+    if all(attributes.get(key) is not None for key in REQUIRED_ATTRIBUTES):
+        checkpoints.save_attributes(CHECKPOINT_SOURCE, device["id"]["id"], attributes)
+
+    return attributes
+
+
+def import_station(device, ts_id, ts_key):
+    """
+    Fetch a station's primary channel from ThingSpeak and send anything new to the server.  Returns number of records sent.
+    We only ask ThingSpeak for rows since the last one we sent; that row is requested again because its 10 minute average may
+    have been incomplete last time.  The first time we see a station, we fetch its entire history.
+    """
+    token = tbapi.get_device_token(device)
+
+    last_sent = checkpoints.get_high_water(CHECKPOINT_SOURCE, device["name"])
+    feeds = fetch_channel(ts_id, ts_key, PRIMARY_FIELDS, start=last_sent)
+    payloads = checkpoints.filter_changed(CHECKPOINT_SOURCE, device["name"], make_payloads(feeds))
+
+    for i in range(0, len(payloads), UPLOAD_BATCH_SIZE):
+        batch = payloads[i:i + UPLOAD_BATCH_SIZE]
 
         try:
-            if len(payloads) > 0:
-                ctr += 1
-                print(ctr)
-                # print(payloads)
-                tbapi.send_telemetry(token, payloads)
+            tbapi.send_telemetry(token, batch)
         except:
             print("Sleeping")
             time.sleep(10)
-            tbapi.send_telemetry(token, payloads)
-            # for p in payloads:
-            #     print("Single mode:", p)
-            #     tbapi.send_telemetry(token, p)
+            tbapi.send_telemetry(token, batch)
 
-            # exit()
-    # print(new_stations)
+        checkpoints.remember(CHECKPOINT_SOURCE, device["name"], batch)
 
-    # https://www.purpleair.com/json?show=s["ID"]  -- Basic info
-    # https://api.thingspeak.com/channels/421294/fields/123456789.json?offset=0&round=2&average=10&results=4800&api_key=S93EJNPS5Z4A5SL7
+    return len(payloads)
 
 
-def add_new_stations(known_station_ids):
-    # Get a list of all PurpleAir sensors
-    req = requests.get("https://www.purpleair.com/json?fetchData=true&minimize=true&sensorsActive2=10080&orderby=L")
-    stations = json.loads(req.text)
+def fetch_channel(channel_id, api_key, fields, start=None):
+    """
+    Retrieve the history of a ThingSpeak channel, or everything since start (epoch ms) if specified.  We page backwards from the
+    present, since ThingSpeak caps the number of rows per request, reusing pooled keep-alive connections.  Returns feeds oldest first.
+    """
+    url = "https://api.thingspeak.com/channels/" + str(channel_id) + "/fields/" + fields + ".json"
+    pages = []
+    end = None
+
+    while True:
+        params = {"offset": 0, "round": 2, "average": 10, "results": THINGSPEAK_PAGE_SIZE, "timezone": "UTC", "api_key": api_key}
+
+        if start is not None:
+            params["start"] = make_thingspeak_date(start)
+        if end is not None:
+            params["end"] = make_thingspeak_date(end)
+
+        req = session.get(url, params=params, timeout=60)
+        req.raise_for_status()
+        feeds = req.json()["feeds"]
 
-    # Get a list of PA stations already in TB:
+        if not feeds:
+            break
+
+        pages.append(feeds)
+
+        oldest = parse_created_at(feeds[0]["created_at"])
+        if end is not None and oldest >= end:      # Not getting anywhere
+            break
+
+        end = oldest - 1000
+
+    return [f for page in reversed(pages) for f in page]
+
+
+def parse_created_at(created_at):
+    """
+    '2018-05-05T14:10:00Z' ==> epoch ms.  fromisoformat is many times faster than strptime, which adds up over a full history.
+    """
+    return int(datetime.fromisoformat(created_at.replace("Z", "+00:00")).timestamp() * 1000)
+
+
+def make_thingspeak_date(ts):
+    return datetime.utcfromtimestamp(ts / 1000).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def make_payloads(feeds):
+    payloads = []
+
+    for f in feeds:
+        values = {}
+        for field, key in FIELD_MAPPING.items():
+            if f[field] is not None:
+                values[key] = float(f[field])
+
+        if len(values) > 0:
+            payloads.append({"ts": parse_created_at(f["created_at"]), "values": values})
+
+    return payloads
+
+
+def add_new_stations(known_station_ids):
+    # Find PurpleAir sensors in our bounding box that we don't know about yet
     new_stations = {}
 
-    for station in stations["results"]:
+    for station in iter_purpleair_stations():
         # Reject stations outside our bounding box
-        if not (station["Lat"] is not None and station["Lon"] is not None and station["Lat"] > ll[0] and station["Lat"] < ur[0] and station["Lon"] > ll[1] and station["Lon"] < ur[1]):
+        if not in_bounding_box(station):
             continue
 
         # Skip over known stations
@@ -138,41 +224,70 @@ def add_new_stations(known_station_ids):
         new_stations[station["ID"]] = (station)
 
 
+    # Look up details for all the new stations at once
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        details = list(executor.map(get_station_details, new_stations.keys()))
+
     # Add new stations to the database
 
-    for sid, s in new_stations.items():
-        if s["ParentID"] is None:       # This is a primary station
-            # print(s["ID"], s["Lat"], s["Lon"])
-            req = requests.get("https://www.purpleair.com/json?show=" + str(s["ID"]))
+    for (sid, s), results in zip(new_stations.items(), details):
+        info_p = results[0]
+        info_s = results[1]
+        # print(info_p)
+        location = info_p["DEVICE_LOCATIONTYPE"]
+
+        # Skip indoor devices
+        if location != 'outside':
+            continue
+
+        if info_p["ParentID"] is not None and info_s["ParentID"] is None:
+            info_p, info_s = info_s, info_p     # Swap, should never happen
+            print("Swapped primary and secondary", results)
+
+
+        thingspeak_primary_id  = info_p["THINGSPEAK_PRIMARY_ID"]
+        thingspeak_primary_key = info_p["THINGSPEAK_PRIMARY_ID_READ_KEY"]
+
+        thingspeak_secondary_id  = info_s["THINGSPEAK_PRIMARY_ID"]
+        thingspeak_secondary_key = info_s["THINGSPEAK_PRIMARY_ID_READ_KEY"]
+
+        server_attributes = { "latitude" : s["Lat"], "longitude" : s["Lon"], 
+                              "primary_foreign_id"   : thingspeak_primary_id,   "primary_foreign_key"   : thingspeak_primary_key,
+                              "secondary_foreign_id" : thingspeak_secondary_id, "secondary_foreign_key" : thingspeak_secondary_key
+                            }
+
+        print("Adding device %s" % str(sid))
+        dev = tbapi.add_device("PurpleAir " + str(sid), "PurpleAir", None, server_attributes)
+
 
-            info_p = json.loads(req.text)["results"][0]
-            info_s = json.loads(req.text)["results"][1]
-            # print(info_p)
-            parent = info_p["ParentID"]
-            location = info_p["DEVICE_LOCATIONTYPE"]
+def iter_purpleair_stations():
+    """
+    Yields every sensor in PurpleAir's (very large) list.  If ijson is available, we parse the response as it streams in, so
+    we never hold the whole thing in memory; otherwise we fall back to loading it all at once.
+    """
+    req = session.get("https://www.purpleair.com/json?fetchData=true&minimize=true&sensorsActive2=10080&orderby=L", stream=True, timeout=120)
+    req.raise_for_status()
 
-            # Skip indoor devices
-            if location != 'outside':
-                continue
+    if ijson is None:
+        yield from req.json()["results"]
+        return
 
-            if info_p["ParentID"] is not None and info_s["ParentID"] is None:
-                infp_p, info_s = info_s, info_p     # Swap, should never happen
-                print("Swapped primary and secondary", json.loads(req.text)["results"])
+    req.raw.decode_content = True       # Let urllib3 undo any gzip encoding before ijson sees the bytes
+    yield from ijson.items(req.raw, "results.item", use_float=True)
 
 
-            thingspeak_primary_id  = info_p["THINGSPEAK_PRIMARY_ID"]
-            thingspeak_primary_key = info_p["THINGSPEAK_PRIMARY_ID_READ_KEY"]
+def in_bounding_box(station):
+    return station["Lat"] is not None and station["Lon"] is not None and ll[0] < station["Lat"] < ur[0] and ll[1] < station["Lon"] < ur[1]
 
-            thingspeak_secondary_id  = info_s["THINGSPEAK_PRIMARY_ID"]
-            thingspeak_secondary_key = info_s["THINGSPEAK_PRIMARY_ID_READ_KEY"]
 
-            server_attributes = { "latitude" : s["Lat"], "longitude" : s["Lon"], 
-                                  "primary_foreign_id"   : thingspeak_primary_id,   "primary_foreign_key"   : thingspeak_primary_key,
-                                  "secondary_foreign_id" : thingspeak_secondary_id, "secondary_foreign_key" : thingspeak_secondary_key
-                                }
+def get_station_details(sid):
+    """
+    Returns the [primary, secondary] records PurpleAir has for the station.
+    """
+    req = session.get("https://www.purpleair.com/json?show=" + str(sid), timeout=60)
+    req.raise_for_status()
 
-            print("Adding device %s" % str(sid))
-            dev = tbapi.add_device("PurpleAir " + str(sid), "PurpleAir", None, server_attributes)
+    return req.json()["results"]
 
 main()
 
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# Load test for redlight_greenlight.py.  Starts stub ThingsBoard and Google geolocation servers on localhost, runs the web.py app
+# in-process against them, then replays a simulated fleet's /update/, /firmware, /hotspots/ and /validatekey traffic at a fixed
+# concurrency for a fixed time, and reports requests/sec and p50/p99 latency per endpoint.  Nothing outside this machine is touched;
+# a throwaway redlight_greenlight_config and firmware folder are generated for the run.
+#
+# Save a run with --save results.json, and compare a later run against it with --baseline results.json.
+#
+# Run with: python loadtest.py [--duration 30] [--concurrency 20] [--devices 500] [--upstream-latency 20]
+import argparse
+import http.client
+import http.server
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Share of requests going to each endpoint; devices check for updates far more often than anything else happens
+TRAFFIC_MIX = {
+    "update": 45,
+    "hotspots": 25,
+    "validatekey": 25,
+    "firmware": 5,
+}
+
+CURRENT_VERSION = (1, 5)
+STUB_LOCATION = {"location": {"lat": 45.5231, "lng": -122.6765}, "accuracy": 35.0}
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_token(device_name):
+    return "token-" + device_name
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers the handful of ThingsBoard and Google calls redlight_greenlight makes, after sleeping for upstream_latency seconds to
+    stand in for the round trip to the real thing.  Anything we don't specifically recognize gets an empty JSON object.
+    """
+    protocol_version = "HTTP/1.1"
+    upstream_latency = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.upstream_latency)
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == "/api/tenant/devices":
+            name = (query.get("deviceName") or query.get("textSearch") or [""])[0]
+
+            if name.startswith("unknown"):
+                if "deviceName" in query:
+                    return self.send_json({"status": 404, "message": "Requested item wasn't found!"}, status=404)
+                return self.send_json({"data": [], "hasNext": False})
+
+            device = {"id": {"entityType": "DEVICE", "id": name}, "name": name, "type": "Birdhouse"}
+            return self.send_json(device if "deviceName" in query else {"data": [device], "hasNext": False})
+
+        if url.path.startswith("/api/device/") and url.path.endswith("/credentials"):
+            device_id = url.path.split("/")[3]
+            return self.send_json({"credentialsType": "ACCESS_TOKEN", "credentialsId": make_token(device_id)})
+
+        self.send_json({})
+
+    def do_POST(self):
+        time.sleep(self.upstream_latency)
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if self.path.startswith("/api/auth/login"):
+            return self.send_json({"token": "stub-jwt", "refreshToken": "stub-refresh"})
+
+        if self.path.startswith("/geolocation/v1/geolocate"):
+            return self.send_json(STUB_LOCATION)
+
+        self.send_json({})
+
+
+def start_stub_server(upstream_latency):
+    handler = type("Handler", (StubHandler,), {"upstream_latency": upstream_latency})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", get_free_port()), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+class StubGeolocationClient:
+    """
+    Stands in for googlemaps.Client, which always talks to www.googleapis.com; makes the same call against our stub instead.
+    """
+    def __init__(self, base_url):
+        self.url = base_url + "/geolocation/v1/geolocate?key=stub"
+
+    def geolocate(self, wifi_access_points=None):
+        body = json.dumps({"wifiAccessPoints": wifi_access_points}).encode()
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+
+
+def write_config(folder, stub_url, firmware_folder, max_concurrent_downloads):
+    with open(os.path.join(folder, "redlight_greenlight_config.py"), "w") as f:
+        f.write("motherShipUrl = %r\n" % stub_url)
+        f.write("username = 'loadtest@example.com'\n")
+        f.write("password = 'loadtest'\n")
+        f.write("data_encoding = 'utf-8'\n")
+        f.write("google_geolocation_key = 'stub'\n")
+        f.write("firmware_images_folder = %r\n" % firmware_folder)
+        f.write("rollout_percentage = 100\n")
+        f.write("max_concurrent_downloads = %d\n" % max_concurrent_downloads)
+
+
+def write_firmware(folder, size):
+    with open(os.path.join(folder, "firmware_%d.%d.bin" % CURRENT_VERSION), "wb") as f:
+        f.write(os.urandom(size))
+
+
+def start_app(args, workdir):
+    """
+    Imports redlight_greenlight against a generated config and serves it on a free port.  Returns the base URL.
+    """
+    stub = start_stub_server(args.upstream_latency / 1000)
+    stub_url = "http://127.0.0.1:%d" % stub.server_address[1]
+
+    firmware_folder = os.path.join(workdir, "firmware")
+    os.mkdir(firmware_folder)
+    write_firmware(firmware_folder, args.firmware_size)
+    write_config(workdir, stub_url, firmware_folder, args.max_concurrent_downloads)
+
+    # Our generated config must win over any real one sitting next to the app
+    sys.path.insert(0, workdir)
+    sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+    import redlight_greenlight as rg
+
+    rg.gmaps = StubGeolocationClient(stub_url)
+
+    if not args.verbose:
+        rg.web.debug = lambda *args, **kwargs: None
+
+    port = get_free_port()
+    server = rg.web.httpserver.WSGIServer(("127.0.0.1", port), rg.app.wsgifunc())
+    threading.Thread(target=server.start, daemon=True).start()
+
+    wait_for_port(port)
+
+    return "http://127.0.0.1:%d" % port
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+
+    raise RuntimeError("Server didn't start listening on port %d" % port)
+
+
+def make_fleet(count, outdated_fraction, seed):
+    """
+    Each simulated device has a fixed name, MAC address, location and set of nearby access points, like a real birdhouse.
+    """
+    rand = random.Random(seed)
+    fleet = []
+
+    for i in range(count):
+        mac = ":".join("%02X" % rand.randrange(256) for _ in range(6))
+        outdated = rand.random() < outdated_fraction
+        fleet.append({
+            "name": "birdhouse-%04d" % i,
+            "mac": mac,
+            "version": "%d.%d" % (CURRENT_VERSION[0], CURRENT_VERSION[1] - 1 if outdated else CURRENT_VERSION[1]),
+            "latitude": 45.5 + rand.uniform(-0.1, 0.1),
+            "longitude": -122.6 + rand.uniform(-0.1, 0.1),
+            "bssids": [":".join("%02x" % rand.randrange(256) for _ in range(6)) for _ in range(rand.randint(3, 10))],
+        })
+
+    return fleet
+
+
+def make_request(device, endpoint, rand):
+    """
+    Returns (method, path, headers, body) for one request like the ones device would send.
+    """
+    if endpoint == "update":
+        headers = {
+            "User-Agent": "ESP8266-http-Update",
+            "X-ESP8266-STA-MAC": device["mac"],
+            "X-ESP8266-Version": device["version"],
+            "X-ESP8266-Mode": "sketch",
+        }
+        return "GET", "/update/ok", headers, None
+
+    if endpoint == "firmware":
+        return "GET", "/firmware", {}, None
+
+    if endpoint == "hotspots":
+        # Signal strengths vary from scan to scan; the access points themselves don't
+        hotspots = [{"macAddress": bssid, "signalStrength": rand.randint(-90, -40), "channel": rand.randint(1, 11)} for bssid in device["bssids"]]
+        body = json.dumps({
+            "latitude": device["latitude"],
+            "longitude": device["longitude"],
+            "device_token": make_token(device["name"]),
+            "visibleHotspots": json.dumps(hotspots),
+        })
+        return "POST", "/hotspots/", {"Content-Type": "application/json"}, body.encode()
+
+    # validatekey: mostly correct keys, some typos, and some names that don't exist, as from someone filling in a config form
+    name = device["name"]
+    key = make_token(name)
+    roll = rand.random()
+
+    if roll < 0.05:
+        name = "unknown-" + name
+    elif roll < 0.15:
+        key = key[:-1]
+
+    return "GET", "/validatekey?" + urllib.parse.urlencode({"name": name, "key": key}), {}, None
+
+
+def send(host, port, method, path, headers, body):
+    """
+    Returns (status, seconds).  Like the devices, we open a new connection for each request.
+    """
+    start = time.perf_counter()
+    con = http.client.HTTPConnection(host, port, timeout=60)
+
+    try:
+        con.request(method, path, body=body, headers=dict(headers, Connection="close"))
+        response = con.getresponse()
+        response.read()
+        status = response.status
+    except Exception:
+        status = None
+    finally:
+        con.close()
+
+    return status, time.perf_counter() - start
+
+
+def run_worker(base_url, fleet, endpoints, weights, stop_at, record_after, seed):
+    url = urllib.parse.urlparse(base_url)
+    rand = random.Random(seed)
+    samples = []        # (endpoint, status, seconds)
+
+    while True:
+        now = time.time()
+        if now >= stop_at:
+            return samples
+
+        endpoint = rand.choices(endpoints, weights)[0]
+        method, path, headers, body = make_request(rand.choice(fleet), endpoint, rand)
+        status, elapsed = send(url.hostname, url.port, method, path, headers, body)
+
+        if now >= record_after:
+            samples.append((endpoint, status, elapsed))
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def summarize(samples, duration):
+    results = {}
+
+    for endpoint in sorted({sample[0] for sample in samples}) + ["all"]:
+        selected = [sample for sample in samples if endpoint in ("all", sample[0])]
+        latencies = sorted(sample[2] for sample in selected)
+        statuses = {}
+        for sample in selected:
+            statuses[str(sample[1])] = statuses.get(str(sample[1]), 0) + 1
+
+        results[endpoint] = {
+            "requests": len(selected),
+            "errors": sum(1 for sample in selected if sample[1] is None or sample[1] >= 500),
+            "rps": len(selected) / duration,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": latencies[-1] * 1000 if latencies else 0,
+            "statuses": statuses,
+        }
+
+    return results
+
+
+def change(new, old):
+    if not old:
+        return ""
+    return "%+.0f%%" % ((new - old) / old * 100)
+
+
+def print_report(results, baseline):
+    print("%-12s %9s %7s %9s %9s %9s %9s   %s" % ("endpoint", "requests", "errors", "req/s", "p50 ms", "p99 ms", "max ms", "statuses"))
+
+    for endpoint, r in results.items():
+        print("%-12s %9d %7d %9.1f %9.1f %9.1f %9.1f   %s" % (endpoint, r["requests"], r["errors"], r["rps"], r["p50_ms"], r["p99_ms"], r["max_ms"],
+                                                              ", ".join("%s: %d" % item for item in sorted(r["statuses"].items()))))
+
+        old = baseline.get(endpoint) if baseline else None
+        if old:
+            print("%-12s %9s %7s %9s %9s %9s" % ("  vs base", "", "", change(r["rps"], old["rps"]), change(r["p50_ms"], old["p50_ms"]), change(r["p99_ms"], old["p99_ms"])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test redlight_greenlight against stub ThingsBoard and Google servers")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to measure for (default 30)")
+    parser.add_argument("--warmup", type=float, default=3, help="Seconds of traffic to send before measuring (default 3)")
+    parser.add_argument("--concurrency", type=int, default=20, help="Requests in flight at once (default 20)")
+    parser.add_argument("--devices", type=int, default=500, help="Size of the simulated fleet (default 500)")
+    parser.add_argument("--outdated", type=float, default=0.05, help="Fraction of the fleet running old firmware (default 0.05)")
+    parser.add_argument("--upstream-latency", type=float, default=20, help="Milliseconds each stub ThingsBoard/Google call takes (default 20)")
+    parser.add_argument("--firmware-size", type=int, default=400 * 1024, help="Bytes in the generated firmware image (default 400KB)")
+    parser.add_argument("--max-concurrent-downloads", type=int, default=20, help="Passed to the app's config (default 20)")
+    parser.add_argument("--mix", default=None, help="Traffic mix, e.g. update=45,hotspots=25,validatekey=25,firmware=5")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed, so runs replay the same traffic")
+    parser.add_argument("--save", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Compare results with those saved in this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Leave the app's debug output on")
+    args = parser.parse_args()
+
+    mix = dict(TRAFFIC_MIX)
+    if args.mix:
+        mix = {endpoint: float(weight) for endpoint, weight in (item.split("=") for item in args.mix.split(","))}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    # The generated config and firmware image are removed once the run is over
+    with tempfile.TemporaryDirectory(prefix="redlight_loadtest_") as workdir:
+        base_url = start_app(args, workdir)
+        fleet = make_fleet(args.devices, args.outdated, args.seed)
+
+        print("Testing %s with %d workers for %.0f seconds (after %.0f seconds warmup)..." % (base_url, args.concurrency, args.duration, args.warmup))
+
+        start = time.time()
+        record_after = start + args.warmup
+        stop_at = record_after + args.duration
+
+        # The app prints a line for every update check
+        stdout = sys.stdout
+        if not args.verbose:
+            sys.stdout = open(os.devnull, "w")
+
+        try:
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                futures = [executor.submit(run_worker, base_url, fleet, list(mix), list(mix.values()), stop_at, record_after, args.seed + i)
+                           for i in range(args.concurrency)]
+                samples = [sample for future in futures for sample in future.result()]
+        finally:
+            if sys.stdout is not stdout:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+    results = summarize(samples, args.duration)
+    print_report(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,11 +6,22 @@ import geopy.distance   # sudo pip install geopy
 import re
 import os
 import time
+import threading
+import collections
+import atexit
 import hashlib          # for md5
 
 from thingsboard_api_tools import TbApi # sudo pip install git+git://github.com/eykamp/thingsboard_api_tools.git --upgrade
 
 from redlight_greenlight_config import motherShipUrl, username, password, data_encoding, google_geolocation_key, firmware_images_folder
+import redlight_greenlight_config
+
+# Rollout of new firmware in the main firmware folder.  Only devices whose MAC address hashes into the first rollout_percentage of
+# the fleet are offered it, so a bad build only reaches a canary slice; raise the percentage as confidence grows.  Devices with
+# their own firmware folder aren't subject to this.  Each device that's offered an update still has to wait its turn if
+# max_concurrent_downloads are already in progress.
+ROLLOUT_PERCENTAGE = getattr(redlight_greenlight_config, "rollout_percentage", 100)
+MAX_CONCURRENT_DOWNLOADS = getattr(redlight_greenlight_config, "max_concurrent_downloads", 20)
 
 tbapi = TbApi(motherShipUrl, username, password)
 gmaps = googlemaps.Client(key=google_geolocation_key)
@@ -21,17 +32,143 @@ urls = (
     '/update/(.*)', 'handle_update',
     '/firmware', 'handle_firmware',
     '/validatekey', 'handle_validate_key',
-    '/purpleair/(.*)', 'handle_purpleair'
+    '/purpleair/(.*)', 'handle_purpleair',
+    '/rollout', 'handle_rollout'
 )
 
 app = web.application(urls, globals())
 
+# Firmware images we've already opened, so when the fleet updates at once we aren't reading and hashing the same file over and over.
+# Every request streams from the same cached copy of the image rather than from its own.
+firmware_cache = {}         # full_filename => (mtime, size, bin_image, md5)
+firmware_cache_lock = threading.Lock()
+
+FIRMWARE_CHUNK_SIZE = 64 * 1024     # We send images in pieces this big
+
+GEOLOCATION_CACHE_SIZE = getattr(redlight_greenlight_config, "geolocation_cache_size", 2000)         # Distinct sets of access points we remember
+GEOLOCATION_CACHE_TTL = getattr(redlight_greenlight_config, "geolocation_cache_ttl", 24 * 60 * 60)    # Seconds before we ask Google about a set of access points again
+
+# Device names we've looked up tokens for when validating keys.  Tokens are rarely changed, but keep this short so a regenerated
+# token or newly created device is picked up quickly.
+DEVICE_TOKEN_CACHE_SIZE = getattr(redlight_greenlight_config, "device_token_cache_size", 500)
+DEVICE_TOKEN_CACHE_TTL = getattr(redlight_greenlight_config, "device_token_cache_ttl", 5 * 60)             # Seconds
+UNKNOWN_DEVICE_CACHE_TTL = getattr(redlight_greenlight_config, "unknown_device_cache_ttl", 30)             # Seconds to remember names with no device
+
+# LED updates are written to the server in the background, at most once per device per interval
+ATTRIBUTE_FLUSH_INTERVAL = getattr(redlight_greenlight_config, "attribute_flush_interval", 1.0)           # Seconds
+
 
 def get_immediate_subdirectories(a_dir):
     return [name for name in os.listdir(a_dir)
         if os.path.isdir(os.path.join(a_dir, name))]
 
 
+class TtlLruCache:
+    """
+    Small thread-safe cache.  Entries expire ttl seconds after they were stored, and once the cache is full, the least recently
+    used entry is evicted to make room.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()    # key => (expires, value)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return default
+
+            if entry[0] < time.time():
+                del self.entries[key]
+                return default
+
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+# Google geolocation results, keyed by the set of access points a device could see
+geolocation_cache = TtlLruCache(GEOLOCATION_CACHE_SIZE, GEOLOCATION_CACHE_TTL)
+
+
+# Device name => token, or "" for names that don't match any device
+device_token_cache = TtlLruCache(DEVICE_TOKEN_CACHE_SIZE, DEVICE_TOKEN_CACHE_TTL)
+
+
+# Returns the token for the named device, or None if there is no such device.  Config pages validate keys as the user types,
+# so we keep the answers around briefly rather than making two calls to the server for each keystroke.
+def get_device_token_by_name(name):
+    token = device_token_cache.get(name)
+
+    if token is None:
+        device = tbapi.get_device_by_name(name)
+        token = tbapi.get_device_token(device) if device is not None else ""
+        device_token_cache.put(name, token, ttl=None if token else UNKNOWN_DEVICE_CACHE_TTL)
+
+    return token or None
+
+
+class SharedAttributeWriter:
+    """
+    Write-behind queue for shared attributes.  Updates are merged per device, and a background thread sends whatever has piled up
+    every flush_interval seconds, so callers never wait on the server.  A device that checks in several times within one interval
+    only gets one write, with the newest values.
+    """
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = {}           # device_id => {attribute: value}
+        self.worker = threading.Thread(target=self.run, name="SharedAttributeWriter", daemon=True)
+        self.worker.start()
+
+    def submit(self, device_id, attributes):
+        with self.lock:
+            self.pending.setdefault(device_id, {}).update(attributes)
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        for device_id, attributes in pending.items():
+            try:
+                tbapi.set_shared_attributes(device_id, attributes)
+            except Exception as ex:
+                # Not retried: the device will send fresh values at its next check-in
+                web.debug("Error setting shared attributes for " + device_id + ":", ex)
+
+
+attribute_writer = SharedAttributeWriter(ATTRIBUTE_FLUSH_INTERVAL)
+atexit.register(attribute_writer.flush)     # Don't lose the last interval's updates when we're shut down
+
+
+# A fixed birdhouse sees nearly the same access points every time, with varying signal strengths.  We identify a scan by the sorted
+# list of BSSIDs, ignoring everything else.  Returns None if we can't make sense of the scan.
+def make_hotspot_fingerprint(hotspots):
+    try:
+        # Devices report their scan results as a JSON string
+        if isinstance(hotspots, str):
+            hotspots = json.loads(hotspots)
+
+        return tuple(sorted(hotspot["macAddress"].lower() for hotspot in hotspots))
+    except Exception:
+        return None
+
+
 class handle_purpleair:
     def POST(self, data):
         web.debug("Handling purpleair")
@@ -55,26 +192,24 @@ class handle_hotspots:
             device_token = incoming_data["device_token"]
         except Exception as ex:
             web.debug("Cannot parse incoming packet:", web.data(), ex)
-
-            # Diagnose common configuration problem
-            if '$ss' in decoded:
-                pos = decoded.find('$ss')
-                while(pos > -1):
-                    end = decoded.find(" ", pos)
-                    word = decoded[pos+4:end].strip(',')
-                    web.debug("Missing server attribute", word)
-
-                    pos = decoded.find('$ss', pos + 1)
+            report_missing_server_attributes(decoded)
             return
 
         hotspots = str(incoming_data["visibleHotspots"])
-        web.debug("Geolocating for data " + hotspots)
+        fingerprint = make_hotspot_fingerprint(incoming_data["visibleHotspots"])
+        results = geolocation_cache.get(fingerprint) if fingerprint else None
+        from_cache = results is not None
 
-        try:
-            results = gmaps.geolocate(wifi_access_points=hotspots)
-        except Exception as ex:
-            web.debug("Exception while geolocating", ex)
-            return
+        if from_cache:
+            web.debug("Using cached geolocation for data " + hotspots)
+        else:
+            web.debug("Geolocating for data " + hotspots)
+
+            try:
+                results = gmaps.geolocate(wifi_access_points=hotspots)
+            except Exception as ex:
+                web.debug("Exception while geolocating", ex)
+                return
 
 
         web.debug("Geocoding results for " + device_token + ":", results)
@@ -91,6 +226,10 @@ class handle_hotspots:
             web.debug("Error parsing response from Google Location API!")
             return
 
+        # Only fresh answers; refreshing on a hit would keep a busy device's entry from ever expiring
+        if fingerprint and not from_cache:
+            geolocation_cache.put(fingerprint, results)
+
         web.debug("Calculating distance...")
         try:
             dist = geopy.distance.vincenty((known_lat, known_lng), (wifi_lat, wifi_lng)).m  # In meters!
@@ -108,17 +247,28 @@ class handle_hotspots:
             return
 
 
+# Diagnose common configuration problem
+def report_missing_server_attributes(decoded):
+    if '$ss' in decoded:
+        pos = decoded.find('$ss')
+        while(pos > -1):
+            end = decoded.find(" ", pos)
+            word = decoded[pos+4:end].strip(',')
+            web.debug("Missing server attribute", word)
+
+            pos = decoded.find('$ss', pos + 1)
+
+
 # Returns a copy of the latest version of the firmware
 class handle_firmware:
     def GET(self):
         web.debug("Handling firmware request")
-        return get_firmware(get_path_of_latest_firmware(firmware_images_folder))
+        return get_firmware(firmware_index.get_newest()[2])
 
 
-def get_path_of_latest_firmware(folder, current_major=0, current_minor=0):
-    newest_firmware = None
-    newest_major = current_major
-    newest_minor = current_minor
+# Returns (major, minor, full_filename) of the newest firmware in folder, or (0, 0, None) if there isn't any
+def find_newest_firmware(folder):
+    newest = (0, 0, None)
 
     for file in os.listdir(folder):
         candidate = re.search(r"(\d+)\.(\d+).bin", file)
@@ -126,28 +276,195 @@ def get_path_of_latest_firmware(folder, current_major=0, current_minor=0):
             major = int(candidate.group(1))
             minor = int(candidate.group(2))
 
-            if major > newest_major or (major == newest_major and minor > newest_minor):
-                newest_major = major
-                newest_minor = minor
-                newest_firmware = os.path.join(folder, file)
+            if (major, minor) > newest[:2]:
+                newest = (major, minor, os.path.join(folder, file))
+
+    return newest
+
+
+class FirmwareIndex:
+    """
+    Keeps track of which device-specific folder belongs to which MAC address, and of the newest firmware in each folder, so an
+    update check doesn't have to rescan the firmware folders.  Adding, removing or renaming a file or folder changes the mtime of
+    the folder containing it, so we only rescan folders whose mtime has changed since we last looked.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.root_mtime = None
+        self.folders_by_mac = {}        # MAC address => [device-specific subfolders]
+        self.newest = {}                # folder => (mtime, major, minor, full_filename)
+
+    # Caller must hold self.lock
+    def refresh(self):
+        mtime = os.stat(self.root).st_mtime_ns
+        if mtime == self.root_mtime:
+            return
 
-    return newest_firmware
+        self.folders_by_mac = {}
 
+        # Folders will have a name matching the pattern SOME_READABLE_PREFIX + underscore + MAC_ADDRESS
+        for subdir in get_immediate_subdirectories(self.root):
+            if "_" in subdir:
+                self.folders_by_mac.setdefault(subdir.rsplit("_", 1)[1].upper(), []).append(subdir)
+
+        self.newest = {folder: entry for folder, entry in self.newest.items() if os.path.isdir(folder)}
+        self.root_mtime = mtime
+
+    # Caller must hold self.lock
+    def newest_in(self, folder):
+        mtime = os.stat(folder).st_mtime_ns
+        entry = self.newest.get(folder)
+
+        if entry is None or entry[0] != mtime:
+            entry = (mtime,) + find_newest_firmware(folder)
+            self.newest[folder] = entry
+
+        return entry[1:]
+
+    # Returns the folder holding firmware for the device with the specified MAC address, or None if that's ambiguous
+    def get_folder(self, mac_address):
+        with self.lock:
+            self.refresh()
+            subfolders = self.folders_by_mac.get(mac_address.upper(), [])
+
+        if len(subfolders) > 1:
+            web.debug("Error: found multiple folders for mac address " + mac_address)
+            return None
+
+        # If there is a dedicated folder for this device, search there; if not, use the default folder
+        return os.path.join(self.root, subfolders[0]) if subfolders else self.root
+
+    # Returns (major, minor, full_filename) of the newest firmware in folder (default is the root folder)
+    def get_newest(self, folder=None):
+        with self.lock:
+            self.refresh()
+            return self.newest_in(folder or self.root)
+
+
+firmware_index = FirmwareIndex(firmware_images_folder)
+
+
+class RolloutController:
+    """
+    Decides which devices get offered new firmware, limits how many downloads are in progress at once, and counts what happened
+    for each firmware image.  Devices turned away are told they're up to date, and will ask again at their next update check.
+    """
+    def __init__(self, percentage, max_concurrent_downloads):
+        self.percentage = percentage
+        self.downloads = threading.BoundedSemaphore(max_concurrent_downloads)
+        self.lock = threading.Lock()
+        self.counters = {}          # firmware file => {event => count}
+
+    def in_cohort(self, mac_address):
+        return int(hashlib.md5(mac_address.upper().encode()).hexdigest(), 16) % 100 < self.percentage
+
+    def count(self, firmware, event):
+        with self.lock:
+            counters = self.counters.setdefault(os.path.basename(firmware), {})
+            counters[event] = counters.get(event, 0) + 1
+
+    def get_counters(self):
+        with self.lock:
+            return {firmware: dict(counters) for firmware, counters in self.counters.items()}
+
+    # Returns True if the device should be sent firmware now; if so, caller must call finish_download() when done
+    def start_download(self, mac_address, firmware, device_specific):
+        if not device_specific and not self.in_cohort(mac_address):
+            self.count(firmware, "not_in_cohort")
+            return False
+
+        if not self.downloads.acquire(blocking=False):
+            self.count(firmware, "deferred")
+            return False
+
+        self.count(firmware, "started")
+        return True
+
+    def finish_download(self, firmware, completed):
+        self.downloads.release()
+        self.count(firmware, "completed" if completed else "abandoned")
+
+    # Wraps a chunk generator, releasing the download slot once the image has been sent (or the client has gone away)
+    def track(self, chunks, firmware):
+        completed = False
+        try:
+            yield from chunks
+            completed = True
+        finally:
+            self.finish_download(firmware, completed)
+
+
+rollout = RolloutController(ROLLOUT_PERCENTAGE, MAX_CONCURRENT_DOWNLOADS)
+
+
+# Returns True if full_filename is in one of the device-specific subfolders, rather than the main firmware folder
+def is_device_specific(full_filename):
+    return os.path.dirname(full_filename) != firmware_images_folder.rstrip(os.sep)
+
+
+# Returns the image and its md5; we only reread the file if it has changed since we last looked.  We keep our own copy rather than
+# mapping the file, so a file overwritten in place can't change (or pull out from under) downloads already in progress.
+def load_firmware(full_filename):
+    stat = os.stat(full_filename)
+
+    with firmware_cache_lock:
+        cached = firmware_cache.get(full_filename)
+
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2], cached[3]
 
-def get_firmware(full_filename):
     with open(full_filename, 'rb') as file:
         bin_image = file.read()
-        byte_count = str(len(bin_image))
-        md5 = hashlib.md5(bin_image).hexdigest()
 
-        web.debug("Sending firmware (" + byte_count + " bytes), with hash " + md5)
+    md5 = hashlib.md5(bin_image).hexdigest()
 
-        web.header("Content-type", "application/octet-stream")
-        web.header("Content-transfer-encoding", "base64")
-        web.header("Content-length", byte_count)
-        web.header("X-MD5", md5)
+    with firmware_cache_lock:
+        # Forget images that have since been deleted, so old releases don't hang around in memory
+        for filename in [f for f in firmware_cache if not os.path.exists(f)]:
+            del firmware_cache[filename]
 
-        return bin_image
+        firmware_cache[full_filename] = (stat.st_mtime_ns, stat.st_size, bin_image, md5)
+
+    return bin_image, md5
+
+
+# Returns True if the client tells us it already has the image with the specified md5, either through a standard conditional
+# request, or because it is the sketch the ESP8266 is running right now
+def client_has_firmware(md5, if_none_match, sketch_md5):
+    if if_none_match and md5 in [tag.strip().strip('"') for tag in if_none_match.split(",")]:
+        return True
+
+    return sketch_md5 is not None and sketch_md5.lower() == md5
+
+
+def get_firmware(full_filename):
+    bin_image, md5 = load_firmware(full_filename)
+    byte_count = str(len(bin_image))
+
+    if client_has_firmware(md5, web.ctx.env.get('HTTP_IF_NONE_MATCH'), web.ctx.env.get('HTTP_X_ESP8266_SKETCH_MD5')):
+        web.debug("Client already has firmware with hash " + md5)
+        web.header("ETag", '"' + md5 + '"')
+        raise web.NotModified()
+
+    web.debug("Sending firmware (" + byte_count + " bytes), with hash " + md5)
+
+    web.header("Content-type", "application/octet-stream")
+    web.header("Content-transfer-encoding", "base64")
+    web.header("Content-length", byte_count)
+    web.header("X-MD5", md5)
+    web.header("ETag", '"' + md5 + '"')
+
+    # WSGI servers insist on bytes, so copy out one chunk at a time
+    return (bytes(chunk) for chunk in stream_firmware(bin_image))
+
+
+# Returning a generator makes the response go out as it is generated, so each request holds only one chunk at a time.  Chunks are
+# views onto the shared cached image, not copies.
+def stream_firmware(bin_image):
+    view = memoryview(bin_image)
+    for offset in range(0, len(view), FIRMWARE_CHUNK_SIZE):
+        yield view[offset:offset + FIRMWARE_CHUNK_SIZE]
 
 
 class handle_update:
@@ -157,25 +474,10 @@ class handle_update:
         current_major = int(v.group(1))
         current_minor = int(v.group(2))
 
-        device_specific_subfolder = None
+        folder = firmware_index.get_folder(mac_address)
 
-        # If there is a dedicated folder for this device, search there; if not, use the default firmware_images_folder
-        subdirs = get_immediate_subdirectories(firmware_images_folder)
-
-        for subdir in subdirs:
-            print(subdir)
-            # Folders will have a name matching the pattern SOME_READABLE_PREFIX + underscore + MAC_ADDRESS
-            if re.match(".*_" + mac_address.upper(), subdir):
-                if device_specific_subfolder is not None:
-                    web.debug("Error: found multiple folders for mac address " + mac_address)
-                    return None
-                device_specific_subfolder = subdir
-
-
-        if device_specific_subfolder is None:
-            folder = firmware_images_folder
-        else:
-            folder = os.path.join(firmware_images_folder, device_specific_subfolder)
+        if folder is None:
+            return None
 
         print("Using firmware folder " + folder)
 
@@ -183,7 +485,9 @@ class handle_update:
             print("Error>>> " + folder + " is not a folder!")
             return
 
-        return get_path_of_latest_firmware(folder, current_major, current_minor)
+        major, minor, newest_firmware = firmware_index.get_newest(folder)
+
+        return newest_firmware if (major, minor) > (current_major, current_minor) else None
 
 
     def GET(self, status):
@@ -214,13 +518,41 @@ class handle_update:
 
         newest_firmware = self.find_firmware_folder(current_version, mac)
 
-        if newest_firmware:
-            web.debug("Upgrading birdhouse to " + newest_firmware)
-            return get_firmware(newest_firmware)
-        else:
+        if not newest_firmware:
             web.debug("Birdhouse already at most recent version (" + current_version + ")")
+            raise web.NotModified()
 
-        raise web.NotModified()
+        # Check this before taking a download slot, so a device already running the image isn't counted as an abandoned download
+        md5 = load_firmware(newest_firmware)[1]
+
+        if client_has_firmware(md5, web.ctx.env.get('HTTP_IF_NONE_MATCH'), web.ctx.env.get('HTTP_X_ESP8266_SKETCH_MD5')):
+            web.debug("Client already has firmware with hash " + md5)
+            rollout.count(newest_firmware, "already_current")
+            web.header("ETag", '"' + md5 + '"')
+            raise web.NotModified()
+
+        device_specific = is_device_specific(newest_firmware)
+
+        if not rollout.start_download(mac, newest_firmware, device_specific):
+            web.debug("Holding back " + newest_firmware + " from " + mac + " for now")
+            raise web.NotModified()
+
+        web.debug("Upgrading birdhouse to " + newest_firmware)
+
+        try:
+            chunks = get_firmware(newest_firmware)
+        except Exception:
+            rollout.finish_download(newest_firmware, False)
+            raise
+
+        return rollout.track(chunks, newest_firmware)
+
+
+# Per-firmware counts of devices offered, held back, and sent updates
+class handle_rollout:
+    def GET(self):
+        web.header("Content-type", "application/json")
+        return json.dumps({"percentage": rollout.percentage, "max_concurrent_downloads": MAX_CONCURRENT_DOWNLOADS, "firmware": rollout.get_counters()})
 
 
 class handle_validate_key:
@@ -235,13 +567,11 @@ class handle_validate_key:
         if name == '' or key == '':
             raise web.HTTPError("401 Please specify 'name' and 'key' params")
 
-        device = tbapi.get_device_by_name(name)
+        token = get_device_token_by_name(name)
 
-        if device is None:
+        if token is None:
             return "bad_device"
 
-        token = tbapi.get_device_token(device)
-
         return "true" if token == key else "false"
 
 
@@ -265,7 +595,7 @@ class set_led_color:
 
         outgoing_data = { "LED": color, "lastSeen": int(time.time()) }
 
-        tbapi.set_shared_attributes(device_id, outgoing_data)
+        attribute_writer.submit(device_id, outgoing_data)
 
 
 if __name__ == "__main__":
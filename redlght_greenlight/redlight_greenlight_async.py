@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# asyncio version of redlight_greenlight.py, serving the same routes.  Calls to Google and to ThingsBoard's device API go through a
+# shared, pooled, non-blocking HTTP client, so one slow upstream call no longer holds up every other birdhouse checking in.  Calls
+# that need ThingsBoard's authenticated API still go through TbApi, but on a thread pool rather than on the event loop.
+#
+# Run with: python redlight_greenlight_async.py [port]
+import json
+import sys
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector     # sudo pip install aiohttp
+import geopy.distance   # sudo pip install geopy
+
+import redlight_greenlight as rg    # Reuse the web.py version's ThingsBoard client and firmware helpers
+from redlight_greenlight_config import motherShipUrl, data_encoding, google_geolocation_key
+
+debug = rg.web.debug
+
+GEOLOCATION_URL = "https://www.googleapis.com/geolocation/v1/geolocate"
+
+HTTP_POOL_SIZE = 20         # Max connections we'll keep open to any one upstream host
+HTTP_TIMEOUT = 30           # Seconds
+TBAPI_WORKERS = 10          # Threads available for blocking TbApi calls
+
+tbapi_executor = ThreadPoolExecutor(max_workers=TBAPI_WORKERS)
+
+
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(tbapi_executor, func, *args)
+
+
+async def handle_purpleair(request):
+    debug("Handling purpleair")
+    print("data: ", await request.read())
+    print("passed: ", request.match_info["data"])
+    print("headers: ", request.headers)
+    return web.Response()
+
+
+async def handle_hotspots(request):
+    debug("Handling hotspots")
+    decoded = ""
+    try:
+        decoded = (await request.read()).decode(data_encoding)
+        incoming_data = json.loads(decoded)
+
+        known_lat = incoming_data["latitude"]
+        known_lng = incoming_data["longitude"]
+        device_token = incoming_data["device_token"]
+    except Exception as ex:
+        debug("Cannot parse incoming packet:", decoded, ex)
+        rg.report_missing_server_attributes(decoded)
+        return web.Response()
+
+    hotspots = incoming_data["visibleHotspots"]
+    fingerprint = rg.make_hotspot_fingerprint(hotspots)
+    results = rg.geolocation_cache.get(fingerprint) if fingerprint else None
+    from_cache = results is not None
+
+    http = request.app["http"]
+
+    if from_cache:
+        debug("Using cached geolocation for data " + str(hotspots))
+    else:
+        debug("Geolocating for data " + str(hotspots))
+
+        # Devices report their scan results as a JSON string
+        if isinstance(hotspots, str):
+            hotspots = json.loads(hotspots)
+
+        try:
+            async with http.post(GEOLOCATION_URL, params={"key": google_geolocation_key}, json={"wifiAccessPoints": hotspots}) as resp:
+                results = await resp.json()
+        except Exception as ex:
+            debug("Exception while geolocating", ex)
+            return web.Response()
+
+    debug("Geocoding results for " + device_token + ":", results)
+
+    if "error" in results:
+        debug("Received error from Google API!")
+        return web.Response()
+
+    try:
+        wifi_lat = results["location"]["lat"]
+        wifi_lng = results["location"]["lng"]
+        wifi_acc = results["accuracy"]
+    except Exception:
+        debug("Error parsing response from Google Location API!")
+        return web.Response()
+
+    # Only fresh answers; refreshing on a hit would keep a busy device's entry from ever expiring
+    if fingerprint and not from_cache:
+        rg.geolocation_cache.put(fingerprint, results)
+
+    debug("Calculating distance...")
+    try:
+        dist = geopy.distance.vincenty((known_lat, known_lng), (wifi_lat, wifi_lng)).m  # In meters!
+    except Exception:
+        debug("Error calculating!")
+        return web.Response()
+
+    outgoing_data = {"wifiDistance" : dist, "wifiDistanceAccuracy" : wifi_acc}
+
+    debug("Sending ", outgoing_data)
+    try:
+        async with http.post(motherShipUrl + "/api/v1/" + device_token + "/telemetry", json=outgoing_data) as resp:
+            resp.raise_for_status()
+    except Exception:
+        debug("Error sending location telemetry!")
+
+    return web.Response()
+
+
+async def firmware_response(request, full_filename):
+    bin_image, md5 = await run_blocking(rg.load_firmware, full_filename)
+
+    if rg.client_has_firmware(md5, request.headers.get("If-None-Match"), request.headers.get("X-ESP8266-Sketch-MD5")):
+        debug("Client already has firmware with hash " + md5)
+        raise web.HTTPNotModified(headers={"ETag": '"' + md5 + '"'})
+
+    debug("Sending firmware (" + str(len(bin_image)) + " bytes), with hash " + md5)
+
+    response = web.StreamResponse(headers={
+        "Content-type": "application/octet-stream",
+        "Content-transfer-encoding": "base64",
+        "Content-length": str(len(bin_image)),
+        "X-MD5": md5,
+        "ETag": '"' + md5 + '"',
+    })
+    await response.prepare(request)
+
+    for chunk in rg.stream_firmware(bin_image):
+        await response.write(chunk)
+
+    await response.write_eof()
+    return response
+
+
+# Returns a copy of the latest version of the firmware
+async def handle_firmware(request):
+    debug("Handling firmware request")
+    major, minor, newest_firmware = await run_blocking(rg.firmware_index.get_newest)
+    return await firmware_response(request, newest_firmware)
+
+
+async def handle_update(request):
+    debug("Handling update request")
+    debug(request.match_info["status"])
+    current_version = request.headers.get("X-ESP8266-Version")
+    mac = request.headers.get("X-ESP8266-STA-MAC")
+    debug("Mac %s" % mac)
+
+    newest_firmware = await run_blocking(rg.handle_update().find_firmware_folder, current_version, mac)
+
+    if not newest_firmware:
+        debug("Birdhouse already at most recent version (" + current_version + ")")
+        raise web.HTTPNotModified()
+
+    # Check this before taking a download slot, so a device already running the image isn't counted as an abandoned download
+    md5 = (await run_blocking(rg.load_firmware, newest_firmware))[1]
+
+    if rg.client_has_firmware(md5, request.headers.get("If-None-Match"), request.headers.get("X-ESP8266-Sketch-MD5")):
+        debug("Client already has firmware with hash " + md5)
+        rg.rollout.count(newest_firmware, "already_current")
+        raise web.HTTPNotModified(headers={"ETag": '"' + md5 + '"'})
+
+    device_specific = rg.is_device_specific(newest_firmware)
+
+    if not rg.rollout.start_download(mac, newest_firmware, device_specific):
+        debug("Holding back " + newest_firmware + " from " + mac + " for now")
+        raise web.HTTPNotModified()
+
+    debug("Upgrading birdhouse to " + newest_firmware)
+
+    completed = False
+    try:
+        response = await firmware_response(request, newest_firmware)
+        completed = True
+        return response
+    finally:
+        rg.rollout.finish_download(newest_firmware, completed)
+
+
+# Per-firmware counts of devices offered, held back, and sent updates
+async def handle_rollout(request):
+    return web.json_response({"percentage": rg.rollout.percentage, "max_concurrent_downloads": rg.MAX_CONCURRENT_DOWNLOADS, "firmware": rg.rollout.get_counters()})
+
+
+# Pass two args: name and key.  Returns "true" if key is the correct secret key for named device, "false" otherwise.
+async def handle_validate_key(request):
+    name = request.query.get("name", "")
+    key = request.query.get("key", "")
+
+    if name == "" or key == "":
+        raise web.HTTPUnauthorized(text="Please specify 'name' and 'key' params")
+
+    token = await run_blocking(rg.get_device_token_by_name, name)
+
+    if token is None:
+        return web.Response(text="bad_device")
+
+    return web.Response(text="true" if token == key else "false")
+
+
+async def set_led_color(request):
+    # Decode request data
+    body = (await request.read()).decode(data_encoding)
+    incoming_data = json.loads(body)
+
+    temperature = incoming_data["temperature"]
+    device_id = incoming_data["device_id"]
+
+    debug("Received data for " + device_id + ": ", body)
+
+    if float(temperature) < 8:
+        color = 'GREEN'
+    elif float(temperature) < 15:
+        color = 'YELLOW'
+    else:
+        color = 'RED'
+
+    outgoing_data = { "LED": color, "lastSeen": int(time.time()) }
+
+    rg.attribute_writer.submit(device_id, outgoing_data)
+
+    return web.Response()
+
+
+async def open_http_client(app):
+    app["http"] = ClientSession(connector=TCPConnector(limit_per_host=HTTP_POOL_SIZE), timeout=ClientTimeout(total=HTTP_TIMEOUT))
+
+
+async def close_http_client(app):
+    await app["http"].close()
+
+
+def make_app():
+    app = web.Application()
+    app.add_routes([
+        web.post('/', set_led_color),
+        web.post('/hotspots/', handle_hotspots),
+        web.get('/update/{status:.*}', handle_update),
+        web.get('/firmware', handle_firmware),
+        web.get('/validatekey', handle_validate_key),
+        web.post('/purpleair/{data:.*}', handle_purpleair),
+        web.get('/rollout', handle_rollout),
+    ])
+    app.on_startup.append(open_http_client)
+    app.on_cleanup.append(close_http_client)
+
+    return app
+
+
+if __name__ == "__main__":
+    # Same default port as web.py's app.run()
+    web.run_app(make_app(), port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080)